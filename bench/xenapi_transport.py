@@ -0,0 +1,133 @@
+#!/usr/bin/python
+#
+# Per-call latency and parse time of each XenAPI transport mode, against a
+# local stand-in for the pool master that answers session.login_with_password,
+# VM.get_power_state and VM.get_all_records over both XML-RPC and JSON-RPC.
+#
+# The stand-in speaks plain HTTP, so the cost of a TLS handshake per call, which
+# a new connection per call pays against a real pool master, is not included.
+#
+# usage: bench/xenapi_transport.py [number of VMs] [number of small calls]
+
+import BaseHTTPServer
+import json
+import os
+import SocketServer
+import sys
+import threading
+import time
+import xmlrpclib
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import xentransport
+from xencache_memory import ref, vm_record
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send the headers and body together, not one tiny packet per header
+    wbufsize = -1
+    # (method, protocol, gzip) -> body, encoded once so the server costs next to nothing
+    responses = {}
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        if self.path == '/jsonrpc':
+            method = json.loads(body)['method']
+        else:
+            method = xmlrpclib.loads(body)[1]
+        use_gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+        data = self.responses[(method, self.path == '/jsonrpc', use_gzip)]
+
+        self.send_response(200)
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', self.path == '/jsonrpc' and 'application/json' or 'text/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # a thread per connection, since every proxy keeps its connection open
+    daemon_threads = True
+
+
+def encode_responses(vms):
+    records = dict([(ref('VM', i), vm_record(i)) for i in range(vms)])
+    json_records = dict([(vm, dict(record, snapshot_time=str(record['snapshot_time']))) for vm, record in records.items()])
+    for method, value, json_value in (('session.login_with_password', 'OpaqueRef:session', 'OpaqueRef:session'),
+                                      ('VM.get_power_state', 'Running', 'Running'),
+                                      ('VM.get_all_records', records, json_records)):
+        for is_json, data in ((False, xmlrpclib.dumps(({ 'Status' : 'Success', 'Value' : value },), methodresponse=True)),
+                              (True, json.dumps({ 'jsonrpc' : '2.0', 'result' : json_value, 'id' : 1 }))):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            StandInHandler.responses[(method, is_json, False)] = data
+            StandInHandler.responses[(method, is_json, True)] = compressor.compress(data) + compressor.flush()
+
+
+class OneShotTransport(xentransport.XmlRpcTransport):
+    """ a new connection for every call, which is what xmlrpclib.Server did before python 2.7 """
+
+    def request(self, host, handler, request_body, verbose=0):
+        try:
+            return xentransport.XmlRpcTransport.request(self, host, handler, request_body, verbose)
+        finally:
+            self.connection.close()
+
+
+def timed(func, repeat):
+    start = time.time()
+    for i in range(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+
+if __name__ == "__main__":
+    vms = len(sys.argv) > 1 and int(sys.argv[1]) or 500
+    calls = len(sys.argv) > 2 and int(sys.argv[2]) or 1000
+
+    encode_responses(vms)
+    server = StandInServer(('127.0.0.1', 0), StandInHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    url = 'http://127.0.0.1:%i/' % server.server_address[1]
+
+    one_shot = xmlrpclib.ServerProxy(url, transport=OneShotTransport(xentransport.Connection(url)))
+    modes = [ ('xmlrpc, new connection per call', one_shot),
+              ('xmlrpc', xentransport.xenapi_proxy(url, 'xmlrpc')),
+              ('xmlrpc + gzip', xentransport.xenapi_proxy(url, 'xmlrpc', True)),
+              ('jsonrpc', xentransport.xenapi_proxy(url, 'jsonrpc')),
+              ('jsonrpc + gzip', xentransport.xenapi_proxy(url, 'jsonrpc', True)),
+            ]
+
+    print "%i small calls, VM.get_all_records of %i VMs" % (calls, vms)
+    print "%-32s %12s %18s %16s" % ('', 'ms per call', 'ms per all_records', 'MB all_records')
+    for name, xenapi in modes:
+        session = xenapi.session.login_with_password('root', 'password')['Value']
+        small = timed(lambda: xenapi.VM.get_power_state(session, 'OpaqueRef:VM'), calls)
+        big = timed(lambda: xenapi.VM.get_all_records(session), 3)
+        assert len(xenapi.VM.get_all_records(session)['Value']) == vms
+        size = len(StandInHandler.responses[('VM.get_all_records', name.startswith('json'), name.endswith('gzip'))])
+        print "%-32s %12.3f %18.1f %16.1f" % (name, small * 1000, big * 1000, size / 1024.0 / 1024.0)
+        if isinstance(xenapi, xentransport.JsonRpcProxy):
+            xenapi.connection.close()
+        else:
+            xenapi('close')()
+
+    xml_body = StandInHandler.responses[('VM.get_all_records', False, False)]
+    json_body = StandInHandler.responses[('VM.get_all_records', True, False)]
+    print "parsing VM.get_all_records alone: %.1f ms XML-RPC, %.1f ms JSON-RPC" % (
+        timed(lambda: xmlrpclib.loads(xml_body), 3) * 1000, timed(lambda: json.loads(json_body), 3) * 1000)
+    server.shutdown()
+    server.server_close()
+    # let the handler threads see their connections close before the interpreter goes away
+    time.sleep(0.5)
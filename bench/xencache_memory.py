@@ -0,0 +1,139 @@
+#!/usr/bin/python
+#
+# Memory footprint of the VM records XenCache keeps, before and after they
+# are projected onto VMRecord, for a synthetic pool.
+#
+# The synthetic records carry the full set of fields a XenServer 6.x VM record
+# has, and are run through xmlrpclib the same way a real VM.get_all_records
+# response is, so every string is a separate object just like in mkvm.
+#
+# usage: bench/xencache_memory.py [number of VMs]
+
+import os
+import sys
+import time
+import xmlrpclib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mkvm
+
+
+def deep_size(obj, seen):
+    """ bytes used by obj and everything it references, counting shared objects once """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += deep_size(k, seen) + deep_size(v, seen)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            size += deep_size(v, seen)
+    elif hasattr(obj, '__slots__'):
+        for field in obj.__slots__:
+            size += deep_size(getattr(obj, field), seen)
+    return size
+
+
+def ref(kind, i):
+    return 'OpaqueRef:%s-%08x-0000-0000-0000-%012x' % (kind, i, i)
+
+
+def vm_record(i):
+    return { 'uuid' : '%08x-1111-2222-3333-%012x' % (i, i),
+             'allowed_operations' : ['changing_dynamic_range', 'migrate_send', 'pool_migrate', 'changing_VCPUs_live', 'suspend', 'hard_reboot', 'hard_shutdown', 'clean_reboot', 'clean_shutdown', 'pause', 'checkpoint', 'snapshot', 'export', 'copy'],
+             'current_operations' : {},
+             'power_state' : 'Running',
+             'name_label' : 'app%05i.qa01' % i,
+             'name_description' : 'Created by someone using mkvm.py. 2010-06-01 12:00:00',
+             'user_version' : '1',
+             'is_a_template' : False,
+             'suspend_VDI' : 'OpaqueRef:NULL',
+             'resident_on' : ref('host', i % 16),
+             'affinity' : 'OpaqueRef:NULL',
+             'memory_overhead' : '11534336',
+             'memory_target' : '4294967296',
+             'memory_static_max' : '4294967296',
+             'memory_dynamic_max' : '4294967296',
+             'memory_dynamic_min' : '4294967296',
+             'memory_static_min' : '268435456',
+             'VCPUs_params' : {},
+             'VCPUs_max' : '4',
+             'VCPUs_at_startup' : '4',
+             'actions_after_shutdown' : 'destroy',
+             'actions_after_reboot' : 'restart',
+             'actions_after_crash' : 'restart',
+             'consoles' : [ref('console', i)],
+             'VIFs' : [ref('VIF', i)],
+             'VBDs' : [ref('VBD', 2 * i), ref('VBD', 2 * i + 1)],
+             'crash_dumps' : [],
+             'VTPMs' : [],
+             'PV_bootloader' : 'pygrub',
+             'PV_kernel' : '',
+             'PV_ramdisk' : '',
+             'PV_args' : 'text ks=http://cobbler.example.com/cblr/svc/op/ks/system/app%05i.qa01.loc.example.com' % i,
+             'PV_bootloader_args' : '',
+             'PV_legacy_args' : '',
+             'HVM_boot_policy' : '',
+             'HVM_boot_params' : {},
+             'HVM_shadow_multiplier' : 1.0,
+             'platform' : { 'nx' : 'false', 'acpi' : 'true', 'apic' : 'true', 'pae' : 'true', 'viridian' : 'true' },
+             'PCI_bus' : '',
+             'other_config' : { 'HideFromXenCenter' : 'false', 'FQDN' : 'app%05i.qa01.loc.example.com' % i, 'install-repository' : 'http://cobbler.example.com/cblr/links/el5-x86_64', 'mac_seed' : '%08x-aaaa-bbbb-cccc-%012x' % (i, i), 'linux_template' : 'true', 'install-distro' : 'rhlike' },
+             'domid' : str(i),
+             'domarch' : 'x64',
+             'last_boot_CPU_flags' : { 'vendor' : 'GenuineIntel', 'features' : '77bee3ff-bfebfbff-00000001-28100800' },
+             'is_control_domain' : False,
+             'metrics' : ref('VM_metrics', i),
+             'guest_metrics' : ref('VM_guest_metrics', i),
+             'last_booted_record' : "('struct' ('uuid' '%08x') ('name_label' 'app%05i') %s)" % (i, i, "('x' 'y') " * 150),
+             'recommendations' : '<restrictions><restriction field="memory-static-max" max="34359738368" /><restriction field="vcpus-max" max="8" /><restriction property="number-of-vbds" max="7" /><restriction property="number-of-vifs" max="7" /></restrictions>',
+             'xenstore_data' : { 'vm-data' : '' },
+             'ha_always_run' : False,
+             'ha_restart_priority' : '',
+             'is_a_snapshot' : False,
+             'snapshot_of' : 'OpaqueRef:NULL',
+             'snapshots' : [],
+             'snapshot_time' : xmlrpclib.DateTime('19700101T00:00:00Z'),
+             'transportable_snapshot_id' : '',
+             'blobs' : {},
+             'tags' : [],
+             'blocked_operations' : {},
+             'snapshot_info' : {},
+             'snapshot_metadata' : '',
+             'parent' : 'OpaqueRef:NULL',
+             'children' : [],
+             'bios_strings' : { 'bios-vendor' : 'Xen', 'bios-version' : '', 'system-manufacturer' : 'Xen', 'system-product-name' : 'HVM domU' },
+             'protection_policy' : 'OpaqueRef:NULL',
+             'is_snapshot_from_vmpp' : False,
+             'appliance' : 'OpaqueRef:NULL',
+             'start_delay' : '0',
+             'shutdown_delay' : '0',
+             'order' : '0',
+             'VGPUs' : [],
+             'attached_PCIs' : [],
+             'suspend_SR' : 'OpaqueRef:NULL',
+             'version' : '0',
+           }
+
+
+if __name__ == "__main__":
+    vms = len(sys.argv) > 1 and int(sys.argv[1]) or 10000
+
+    records = dict([(ref('VM', i), vm_record(i)) for i in range(vms)])
+    response = xmlrpclib.dumps(({ 'Status' : 'Success', 'Value' : records },), methodresponse=True)
+    del records
+    raw = xmlrpclib.loads(response)[0][0]['Value']
+
+    start = time.time()
+    compact = mkvm.XenCache(None, None)._compact('vm', raw)
+    elapsed = time.time() - start
+
+    raw_size = deep_size(raw, set())
+    compact_size = deep_size(compact, set())
+    print "%i VM records (%.1f MB of XML-RPC)" % (vms, len(response) / 1024.0 / 1024.0)
+    print "%-10s %12s %12s" % ('', 'total MB', 'per record')
+    print "%-10s %12.1f %12i" % ('raw', raw_size / 1024.0 / 1024.0, raw_size / vms)
+    print "%-10s %12.1f %12i" % ('compact', compact_size / 1024.0 / 1024.0, compact_size / vms)
+    print "%.1fx smaller, projected in %.2fs" % (float(raw_size) / compact_size, elapsed)
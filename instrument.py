@@ -0,0 +1,329 @@
+#============================================================================
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of version 3.0 of the GNU General Public
+# License as published by the Free Software Foundation.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#============================================================================
+# Copyright (C) 2010 David Wahlstrom
+# Copyright (C) 2010 Brett Lentz
+#============================================================================
+#
+# where mkvm.py and vm-zamboni.py spend their time: every XenAPI and cobbler
+# call, with its latency and the bytes it moved, and spans for the phases of
+# each VM.  nothing is recorded unless a Recorder is installed as
+# instrument.recorder, which also does the wrapping of the proxies.  the
+# timeline is written in the Chrome trace event format, which chrome://tracing
+# and https://ui.perfetto.dev load as they are.
+
+import json
+import logging
+import threading
+import time
+import xmlrpclib
+
+log = logging.getLogger("instrument")
+
+# the Recorder in use, or None when nothing is being recorded
+recorder = None
+
+
+class CallStats:
+    """ the calls of one method: how many, how long and how many bytes """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max = 0.0
+        self.sent = 0
+        self.received = 0
+        # upper bound in ms (a power of two) -> calls at most that long
+        self.histogram = {}
+
+    def add(self, seconds, sent, received, failed):
+        self.calls += 1
+        self.errors += failed and 1 or 0
+        self.seconds += seconds
+        self.max = max(self.max, seconds)
+        self.sent += sent
+        self.received += received
+        bucket = 1
+        while bucket < seconds * 1000 and bucket < 2 ** 20:
+            bucket *= 2
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def percentile(self, fraction):
+        """ the histogram bucket the given fraction of calls fall within, in ms """
+        seen = 0
+        for bucket in sorted(self.histogram):
+            seen += self.histogram[bucket]
+            if seen >= fraction * self.calls:
+                return bucket
+        return 0
+
+
+class Span:
+    """ one phase, from when it is made until end() (or the end of a with block) """
+
+    def __init__(self, recorder, name, args):
+        self.recorder = recorder
+        self.name = name
+        self.args = args
+        self.lane = threading.currentThread().getName()
+        self.start = time.time()
+
+    def end(self):
+        self.recorder.add_span(self.name, self.start, time.time(), self.lane, self.args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        if error_type is not None:
+            self.args['error'] = str(error)
+        self.end()
+
+
+class NullSpan:
+    """ what span() hands out when nothing is being recorded """
+
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        pass
+
+null_span = NullSpan()
+
+
+class Recorder:
+    """ call statistics and a timeline of calls and spans.  a long-running
+        process keeps its statistics, but only the first max_events calls
+        and spans make it into the timeline """
+
+    def __init__(self, max_events=200000):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.max_events = max_events
+        self.dropped = 0
+        # (kind, method) -> CallStats
+        self.stats = {}
+        # span name -> [count, seconds, longest]
+        self.phases = {}
+        self.events = []
+        # lane name -> tid in the trace
+        self.lanes = {}
+
+    def wrap(self, proxy, kind, counter=None):
+        """ proxy, with every call through it recorded as kind ('xenapi' or
+            'cobbler').  counter, if given, has the running bytes_sent and
+            bytes_received of the connection under the proxy """
+        return InstrumentedProxy(proxy, self, kind, counter)
+
+    def _event(self, event, lane):
+        """ add an event to the timeline.  call with the lock held """
+        if len(self.events) >= self.max_events:
+            self.dropped += 1
+            return
+        if lane not in self.lanes:
+            self.lanes[lane] = len(self.lanes) + 1
+        event['pid'] = 1
+        event['tid'] = self.lanes[lane]
+        self.events.append(event)
+
+    def call(self, kind, method, start, seconds, sent=0, received=0, failed=False):
+        self.lock.acquire()
+        try:
+            if (kind, method) not in self.stats:
+                self.stats[(kind, method)] = CallStats()
+            self.stats[(kind, method)].add(seconds, sent, received, failed)
+            args = { 'sent' : sent, 'received' : received }
+            if failed:
+                args['failed'] = True
+            self._event({ 'name' : method, 'cat' : kind, 'ph' : 'X', 'ts' : (start - self.started) * 1e6,
+                          'dur' : seconds * 1e6, 'args' : args }, threading.currentThread().getName())
+        finally:
+            self.lock.release()
+
+    def span(self, name, **args):
+        return Span(self, name, args)
+
+    def add_span(self, name, start, end, lane=None, args=None):
+        """ a phase that ran from start to end, on lane (the calling thread by default) """
+        self.lock.acquire()
+        try:
+            phase = self.phases.setdefault(name, [0, 0.0, 0.0])
+            phase[0] += 1
+            phase[1] += end - start
+            phase[2] = max(phase[2], end - start)
+            self._event({ 'name' : name, 'cat' : 'phase', 'ph' : 'X', 'ts' : (start - self.started) * 1e6,
+                          'dur' : (end - start) * 1e6, 'args' : args or {} }, lane or threading.currentThread().getName())
+        finally:
+            self.lock.release()
+
+    def trace(self):
+        """ the timeline and the call statistics, in the Chrome trace event format """
+        self.lock.acquire()
+        try:
+            events = [{ 'name' : 'thread_name', 'ph' : 'M', 'pid' : 1, 'tid' : tid, 'args' : { 'name' : lane } }
+                      for lane, tid in self.lanes.items()]
+            stats = {}
+            for (kind, method), call_stats in self.stats.items():
+                stats['%s %s' % (kind, method)] = { 'calls' : call_stats.calls,
+                                                    'errors' : call_stats.errors,
+                                                    'seconds' : call_stats.seconds,
+                                                    'max_seconds' : call_stats.max,
+                                                    'bytes_sent' : call_stats.sent,
+                                                    'bytes_received' : call_stats.received,
+                                                    'histogram_ms' : dict([(str(bucket), count) for bucket, count in call_stats.histogram.items()]),
+                                                  }
+            return { 'traceEvents' : events + self.events,
+                     'displayTimeUnit' : 'ms',
+                     'otherData' : { 'started' : time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started)),
+                                     'dropped_events' : str(self.dropped) },
+                     'callStats' : stats,
+                   }
+        finally:
+            self.lock.release()
+
+    def write_trace(self, path):
+        trace_file = open(path, 'w')
+        try:
+            json.dump(self.trace(), trace_file)
+        finally:
+            trace_file.close()
+
+    def summary(self):
+        """ the calls that took longest in all, then the phases, as lines of a table """
+        self.lock.acquire()
+        try:
+            lines = ["%-9s %-40s %7s %6s %9s %9s %8s %8s %9s %10s %10s" % ('', 'CALL', 'CALLS', 'ERRORS', 'TOTAL', 'MEAN', 'P50<=', 'P95<=', 'MAX', 'SENT', 'RECEIVED')]
+            for (kind, method), stats in sorted(self.stats.items(), key=lambda item: -item[1].seconds):
+                lines.append("%-9s %-40s %7i %6i %8.2fs %7.1fms %6ims %6ims %7.1fms %8.1fKB %8.1fKB" % (
+                    kind, method, stats.calls, stats.errors, stats.seconds, stats.seconds / stats.calls * 1000,
+                    stats.percentile(0.5), stats.percentile(0.95), stats.max * 1000, stats.sent / 1024.0, stats.received / 1024.0))
+            if self.phases:
+                lines.append('')
+                lines.append("%-50s %7s %9s %9s %9s" % ('PHASE', 'COUNT', 'TOTAL', 'MEAN', 'MAX'))
+                for name, (count, seconds, longest) in sorted(self.phases.items(), key=lambda item: -item[1][1]):
+                    lines.append("%-50s %7i %8.2fs %8.2fs %8.2fs" % (name, count, seconds, seconds / count, longest))
+            return lines
+        finally:
+            self.lock.release()
+
+
+class InstrumentedProxy:
+    """ a stand-in for a XenAPI or cobbler proxy that records every call made
+        through it.  XenAPI calls that come back with a Failure status count
+        as errors, as do calls that raise """
+
+    def __init__(self, proxy, recorder, kind, counter=None, method=None):
+        self._proxy = proxy
+        self._recorder = recorder
+        self._kind = kind
+        self._counter = counter
+        self._method = method
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return InstrumentedProxy(getattr(self._proxy, name), self._recorder, self._kind, self._counter,
+                                 self._method and '%s.%s' % (self._method, name) or name)
+
+    def __call__(self, *args):
+        if self._method is None:
+            # ServerProxy('close') and the like
+            return self._proxy(*args)
+        counter = self._counter
+        sent, received = counter and (counter.bytes_sent, counter.bytes_received) or (0, 0)
+        start = time.time()
+        failed = True
+        try:
+            result = self._proxy(*args)
+            failed = isinstance(result, dict) and result.get('Status') == 'Failure'
+            return result
+        finally:
+            if counter:
+                sent, received = counter.bytes_sent - sent, counter.bytes_received - received
+            self._recorder.call(self._kind, self._method, start, time.time() - start, sent, received, failed)
+
+
+class CountingResponse:
+    """ an HTTP response that counts the bytes read from it """
+
+    def __init__(self, response, counter):
+        self.response = response
+        self.counter = counter
+
+    def read(self, *args):
+        data = self.response.read(*args)
+        self.counter.bytes_received += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+
+class CountingTransport(xmlrpclib.Transport):
+    """ xmlrpclib transport that keeps a running count of the bytes it moves """
+
+    bytes_sent = 0
+    bytes_received = 0
+
+    def send_content(self, connection, request_body):
+        self.bytes_sent += len(request_body)
+        xmlrpclib.Transport.send_content(self, connection, request_body)
+
+    def parse_response(self, response):
+        return xmlrpclib.Transport.parse_response(self, CountingResponse(response, self))
+
+
+class CountingSafeTransport(CountingTransport, xmlrpclib.SafeTransport):
+    """ the same, over https """
+    pass
+
+
+def counting_transport(url):
+    """ a CountingTransport for url """
+    if url.startswith('https'):
+        return CountingSafeTransport()
+    return CountingTransport()
+
+
+def span(name, **args):
+    """ a span of the installed Recorder, or one that records nothing """
+    if recorder is None:
+        return null_span
+    return recorder.span(name, **args)
+
+
+def add_span(name, start, end, lane=None, **args):
+    if recorder is not None:
+        recorder.add_span(name, start, end, lane, args)
+
+
+def finish(path=None, write=None):
+    """ write the installed Recorder's timeline to path, if given, and its
+        summary table with write (one call per line) """
+    if recorder is None:
+        return
+    if path:
+        try:
+            recorder.write_trace(path)
+            log.info("wrote trace of %i events to %s" % (len(recorder.events), path))
+        except (IOError, OSError), e:
+            log.warn("unable to write trace %s: %s" % (path, e))
+    if write:
+        for line in recorder.summary():
+            write(line)
@@ -32,18 +32,33 @@
 #
 # --------------------------------------------------------------------
 
+import atexit
 import ConfigParser
+import cPickle
 import getpass
+import hashlib
+import httplib
 import logging
 import os
 import optparse
+import Queue
+import random
 import shutil
+import SimpleXMLRPCServer
+import socket
+import SocketServer
 import subprocess
 import sys
+import threading
 import time
 from time import strftime
 import traceback
 import xmlrpclib
+from cStringIO import StringIO
+
+from xentasks import XenTaskError, XenTasks, XenBatch, Teardown
+from xentransport import xenapi_proxy, protocols
+import instrument
 
 # Config file format:
 #
@@ -81,13 +96,13 @@ default_template_file="/etc/mkvm/templates"
 
 class VM:
     #instance variables.
-    autostart = False
     cobbler_profile = ''
     fqdn = ''
     existing_vm = False
     hddsize = int(8 * 1024 * 1024 * 1024)
     ksmeta = {}
     ks_url = ''
+    mac_addr = ''
     mgmt_classes = ''
     name = None
     nics = { 'eth0' : { 'dhcptag-eth0': '',
@@ -136,11 +151,26 @@ class XenVM(VM):
     templateconfig = None
     userconfig = None
     sr_aggr = None
+    placement = None
+    image = None
+    warm_type = None
+    # who the VM is created for, in its description and its cobbler comment
+    creator = None
 
-    def __init__(self, name, xencache, xensession):
+    def __init__(self, name, xencache, xenapi, xensession):
         VM.__init__(self, name)
         self.xencache = xencache
+        self.xenapi = xenapi
         self.xensession = xensession
+        # steps a failed run got through already, and the job to journal new ones to
+        self.steps = {}
+        self.job = None
+
+    def _record(self, step, value=''):
+        """ note a step as done, so a rerun does not do it again """
+        self.steps[step] = value
+        if self.job:
+            self.job.record(step, value)
 
     def _set_vmtype(self, vmtype):
         log.debug("in _set_vmtype()")
@@ -152,6 +182,7 @@ class XenVM(VM):
         self.vram = float(self.templateconfig.get_item('vram', vmtype)) * self._gig
         self.storage = self.templateconfig.get_item('storage', vmtype)
         self.usernics = self.templateconfig.get_item('nics', vmtype)
+        self.image = self.templateconfig.get_item('image', vmtype)
 
     def _set_user_config(self):
         log.debug("in _set_user_config()")
@@ -192,12 +223,18 @@ class XenVM(VM):
         if hddsize:
             self.hddsize = int(hddsize) * int(self._gig)
 
+        # apply user-defined golden image, or none to kickstart a type that has one
+        image = self.userconfig.get_item("image", self.name)
+        if image:
+            self.image = image != 'none' and image or None
+
         log.info('App type is %s' % self.vmtype)
         if self.vmtype == 'resin':
             self.mgmt_classes = '%s resin::app::%s' % (self.mgmt_classes, self.hostname.split('-')[0])
 
-        # dnsname always needs to be set.
-        self.nics['eth0'] = { 'dnsname-eth0' : self.fqdn }
+        # dnsname always needs to be set.  nics is rebuilt per instance, since
+        # the class-level dict would otherwise be shared between worker threads.
+        self.nics = { 'eth0' : { 'dnsname-eth0' : self.fqdn } }
         usernics = self.userconfig.get_item(self.name, "nics")
         if usernics:
             for el in range(0, len(usernics)):
@@ -214,9 +251,10 @@ class XenVM(VM):
                     'macaddress-'+iface : '',
                 }
 
-    def configure(self, userconfig, templateconfig, cobbler_server):
+    def configure(self, userconfig, templateconfig, cobbler_server, creator=None):
         log.debug("in configure()")
         self.userconfig = userconfig
+        self.creator = creator and str(creator) or getpass.getuser()
         self.templateconfig = templateconfig
         self.cobbler_server = cobbler_server
         self.fqdn = self.userconfig.get_item('fqdn', self.name)
@@ -231,8 +269,108 @@ class XenVM(VM):
         self._set_vmtype('default')
         self._set_user_config()
 
+    def configure_warm(self, templateconfig, vmtype):
+        """ configure a VM for the warm pool of vmtype: everything the type
+            sets, and no name or identity of its own """
+        log.debug("in configure_warm()")
+        self.templateconfig = templateconfig
+        self.vmtype = self.warm_type = vmtype
+        self._set_vmtype('default')
+        self._set_vmtype(vmtype)
+        self.fqdn = None
+        self.nics = { 'eth0' : {} }
+
+    def _vdi_record(self):
+        """ the record for a new, empty system disk on the chosen aggregate """
+        vdi = { 'read_only' : False ,
+                'sharable' : True ,
+                'SR' : self.xencache.get_sr(self.aggr) ,
+                'name_label' : '/dev/xvda' ,
+                'name_description' : '/dev/xvda on ' + self.name ,
+                'virtual_size' : str(int(self.hddsize)) ,
+                'type' : 'system',
+                'other_config': { 'location': '/dev/xvda' } ,
+              }
+        log.debug("VDI configuration: %s" % vdi)
+        return vdi
+
+    def _image_size(self, vdi_uuid):
+        """ the size of the golden image vdi_uuid was cloned from.  a resumed VM
+            may have no usable placement, so then ask the clone itself """
+        if self.placement and not self.placement.error:
+            return self.placement.image_size
+        return int(self.xenapi.VDI.get_virtual_size(self.xensession, vdi_uuid)['Value'])
+
+    def _identity(self):
+        """ what a VM built from a golden image needs to know about itself on its
+            first boot.  xapi writes these to /local/domain/<domid>/vm-data in
+            xenstore, where the guest reads them with xenstore-read """
+        return { 'vm-data/hostname' : self.hostname,
+                 'vm-data/fqdn' : self.fqdn,
+                 'vm-data/domain' : self.domain,
+                 'vm-data/mgmt_classes' : self.mgmt_classes or '',
+                 'vm-data/nics' : ' '.join(sorted(self.nics)),
+                 'vm-data/mac' : self.mac_addr or '',
+                 'vm-data/cobbler_server' : self.cobbler_server or '',
+               }
+
+    def _add_settings(self, batch, template_record):
+        """ queue every write that makes a fresh clone (or a claimed warm pool VM) this VM """
+        vram = int(self.vram)
+        dynamic_min = min(int(template_record['memory_dynamic_min']), vram)
+        static_min = min(int(template_record['memory_static_min']), dynamic_min)
+        batch.add('template', 'VM.set_is_a_template', self.vm_uuid, False)
+        batch.add('name', 'VM.set_name_label', self.vm_uuid, self.name)
+        batch.add('vcpus max', 'VM.set_VCPUs_max', self.vm_uuid, str(int(self.vcpus)))
+        batch.add('vcpus at startup', 'VM.set_VCPUs_at_startup', self.vm_uuid, str(int(self.vcpus)))
+        # all four limits in one call, so growing past the template's static_max can't trip over the ordering
+        batch.add('memory', 'VM.set_memory_limits', self.vm_uuid, str(static_min), str(vram), str(dynamic_min), str(vram))
+        for key in ('HideFromXenCenter', 'install-repository', 'FQDN', 'mkvm-image', 'mkvm-warm', 'mkvm-claimed'):
+            batch.add('remove %s' % key, 'VM.remove_from_other_config', self.vm_uuid, key)
+        if self.warm_type:
+            # a warm pool VM gets its name and identity when it is claimed
+            batch.add('add HideFromXenCenter', 'VM.add_to_other_config', self.vm_uuid, 'HideFromXenCenter', 'true')
+            batch.add('add warm', 'VM.add_to_other_config', self.vm_uuid, 'mkvm-warm', self.warm_type)
+            batch.add('description', 'VM.set_name_description', self.vm_uuid, "Warm pool VM of type %s, staged by mkvm.py. %s" % (self.warm_type, strftime("%Y-%m-%d %H:%M:%S")))
+            return
+
+        if self.image:
+            # the image is installed already, so it boots its own kernel and learns who it is from xenstore
+            batch.add('bootloader', 'VM.set_PV_bootloader', self.vm_uuid, 'pygrub')
+            batch.add('PV args', 'VM.set_PV_args', self.vm_uuid, '')
+            batch.add('identity', 'VM.set_xenstore_data', self.vm_uuid, self._identity())
+        else:
+            batch.add('PV args', 'VM.set_PV_args', self.vm_uuid, "text ks=" + self.ks_url)
+        if self.placement and self.placement.host:
+            # VM.start boots it on the host its memory was reserved on, as long as that host still has room
+            batch.add('affinity', 'VM.set_affinity', self.vm_uuid, self.placement.host)
+        batch.add('add HideFromXenCenter', 'VM.add_to_other_config', self.vm_uuid, 'HideFromXenCenter', 'false')
+        batch.add('add FQDN', 'VM.add_to_other_config', self.vm_uuid, 'FQDN', self.fqdn)
+        if self.image:
+            batch.add('add image', 'VM.add_to_other_config', self.vm_uuid, 'mkvm-image', self.image)
+        batch.add('description', 'VM.set_name_description', self.vm_uuid, "Created by " + self.creator + " using mkvm.py. " + strftime("%Y-%m-%d %H:%M:%S"))
+
+    def _send_settings(self, batch):
+        """ send a batch from _add_settings and return its results """
+        settings_span = instrument.span('settings', vm=self.name)
+        try:
+            results = batch.send(ignore_errors=True)
+            if batch.errors.get('memory', [''])[0] == 'MESSAGE_METHOD_UNKNOWN':
+                # servers older than 5.6 have no set_memory_limits
+                del batch.errors['memory']
+                batch.add('memory dynamic max', 'VM.set_memory_dynamic_max', self.vm_uuid, str(int(self.vram)))
+                batch.add('memory static max', 'VM.set_memory_static_max', self.vm_uuid, str(int(self.vram)))
+                results = batch.send(ignore_errors=True)
+        finally:
+            settings_span.end()
+        if batch.errors:
+            raise XenTaskError(batch.errors)
+        return results
+
     def create(self):
-        """ this section will create the disk image for the VM, set its properties and prepare it to boot """
+        """ this section will create the disk image for the VM, set its properties and prepare it to boot.
+            the slow storage operations are submitted as XenAPI tasks, so the ones that do not depend
+            on each other run at the same time on the pool master """
 
         log.debug("in create_vm()")
         log.info('Creating VM %s' % self.name)
@@ -240,37 +378,69 @@ class XenVM(VM):
         if not self.sr_aggr:
             log.warn('Unable to find shared storage!')
 
-        # Find which aggregate to put the disk on
-        self.aggr = self._find_best_aggr()
-
-        self.vm_uuid = xenapi.VM.clone(self.xensession, xenapi.VM.get_by_name_label(self.xensession, self.vm_template)['Value'][0], self.name)['Value']
-        xenapi.VM.set_is_a_template(self.xensession, self.vm_uuid, False)
-        self.vm_uuid = self.vm_uuid
-
-        log.info('new vm uuid is %s' % self.vm_uuid)
+        # the aggregate to put the disk on was picked for the whole batch by the PlacementPlanner
+        if self.placement:
+            self.aggr = self.placement.sr
+        else:
+            log.warn("Unable to determine storage repository")
 
-        # Set VM parameters (RAM, CPU, etc.)
-        xenapi.VM.set_VCPUs_max(self.xensession, self.vm_uuid, str(int(self.vcpus)))
-        xenapi.VM.set_VCPUs_at_startup(self.xensession, self.vm_uuid, str(int(self.vcpus)))
-        xenapi.VM.set_memory_dynamic_max(self.xensession, self.vm_uuid, str(int(self.vram)))
-        xenapi.VM.set_memory_static_max(self.xensession, self.vm_uuid, str(int(self.vram)))
-        xenapi.VM.set_PV_args(self.xensession, self.vm_uuid, "text ks=" + self.ks_url)
-        try:
-            xenapi.VM.remove_from_other_config(self.xensession, self.vm_uuid, 'HideFromXenCenter')
-        except:
-            pass
-        xenapi.VM.add_to_other_config(self.xensession, self.vm_uuid, 'HideFromXenCenter', 'false')
-        try:
-            xenapi.VM.remove_from_other_config(self.xensession, self.vm_uuid, 'install-repository')
-        except:
-            pass
-        if options.cblr_username:
-            xenapi.VM.set_name_description(self.xensession, self.vm_uuid, "Created by " + str(options.cblr_username) + " using mkvm.py. " + strftime("%Y-%m-%d %H:%M:%S"))
+        template_uuid = self.xencache.get_template(self.vm_template)
+        if not template_uuid:
+            raise ValueError("there is no template named '%s'" % self.vm_template)
+        template_record = self.xencache._get_all_vm_records()[template_uuid]
+        tasks = XenTasks(self.xenapi, self.xensession)
+
+        if 'cloned' in self.steps:
+            # a failed run got this far
+            self.vm_uuid = self.steps['cloned']
+            vdi_uuid = self.steps.get('vdi-created') or None
+            log.info('resuming VM %s (%s)' % (self.vm_uuid, ', '.join(sorted(self.steps))))
         else:
-            xenapi.VM.set_name_description(self.xensession, self.vm_uuid, "Created by " + getpass.getuser() + " using mkvm.py. " +strftime("%Y-%m-%d %H:%M:%S"))
+            tasks.submit('clone', 'VM.clone', template_uuid, self.name)
+
+            # a template without disks gets a new one, or a copy-on-write clone of
+            # the golden image.  that does not depend on the clone, so do both at once.
+            if self.image:
+                if not self.placement or not self.placement.image_vdi:
+                    raise ValueError("there is no golden image named '%s' on the shared storage" % self.image)
+                log.info("Cloning golden image %s on %s" % (self.image, self.aggr))
+                tasks.submit('vdi', 'VDI.clone', self.placement.image_vdi, {})
+            elif not template_record['VBDs']:
+                log.info("Building a(n) %sGB disk" % int(self.hddsize / 1024 / 1024 / 1024))
+                tasks.submit('vdi', 'VDI.create', self._vdi_record())
+            clone_span = instrument.span('clone', vm=self.name)
+            try:
+                results = tasks.wait()
+            except XenTaskError:
+                # neither half is journaled yet, so whichever one made it is thrown away
+                if 'vdi' in tasks.results:
+                    self.xenapi.VDI.destroy(self.xensession, tasks.results['vdi'])
+                if 'clone' in tasks.results:
+                    self.xenapi.VM.destroy(self.xensession, tasks.results['clone'])
+                raise
+            finally:
+                clone_span.end()
+            self.vm_uuid = results['clone']
+            vdi_uuid = results.get('vdi')
+            if vdi_uuid:
+                self._record('vdi-created', vdi_uuid)
+            self._record('cloned', self.vm_uuid)
+            log.info('new vm uuid is %s' % self.vm_uuid)
+
+        # every write to the new VM, plus the reads the rest of create() needs, in one batch
+        batch = XenBatch(self.xenapi, self.xensession)
+        self._add_settings(batch, template_record)
+        if self.image:
+            # the clone still carries the golden image's name
+            batch.add('VDI name', 'VDI.set_name_label', vdi_uuid, '/dev/xvda')
+            batch.add('VDI description', 'VDI.set_name_description', vdi_uuid, '/dev/xvda on %s (from %s)' % (self.name, self.image))
+        batch.add('networks', 'network.get_all_records')
+        if not vdi_uuid:
+            batch.add('VBDs', 'VM.get_VBDs', self.vm_uuid)
+        results = self._send_settings(batch)
 
         network_uuid = ''
-        network_records = xenapi.network.get_all_records(self.xensession)['Value']
+        network_records = results['networks']
         # try to find the default network
         for k in network_records:
             if "other_config" in network_records[k] and 'automatic' in network_records[k]['other_config'] and network_records[k]['other_config']['automatic'] == 'true':
@@ -287,45 +457,51 @@ class XenVM(VM):
 
         log.info('network uuid is %s' % network_uuid)
 
-        # create the VIF (network card)
+        # create the VIF (network card) and finish the disk together
         vif = { 'device': '0',
                 'network': network_uuid,
                 'VM': self.vm_uuid,
-                'MAC': "",
+                'MAC': self.mac_addr,
                 'MTU': '1500',
                 'qos_algorithm_type': "",
                 'qos_algorithm_params': {},
                 'other_config': {},
               }
-        vif_uuid = xenapi.VIF.create(self.xensession, vif)['Value']
-        self.mac_addr = xenapi.VIF.get_record(self.xensession, vif_uuid)['Value']['MAC']
+        if 'vif-created' not in self.steps:
+            tasks.submit('vif', 'VIF.create', vif)
 
         #resize the disk if the template created one for the vm
-        if xenapi.VM.get_VBDs(self.xensession, self.vm_uuid)['Value']:
+        disks = []
+        disk_labels = []
+        if 'disk-sized' in self.steps:
+            pass
+        elif not vdi_uuid:
+            vbds = results['VBDs']
+            for vbd_uuid in vbds:
+                batch.add(vbd_uuid, 'VBD.get_record', vbd_uuid)
+            results = batch.send()
+            for vbd_uuid in vbds:
+                if results[vbd_uuid]['type'] == 'Disk':
+                    disks.append(results[vbd_uuid]['VDI'])
+        if disks:
             log.info("Resizing VM disk to %sGB" % int(self.hddsize / 1024 / 1024 / 1024))
-            vdb_uuid = xenapi.VM.get_VBDs(self.xensession, self.vm_uuid)['Value']
-            vdi_uuid = xenapi.VDB.get_VDI(self.xensession, vdb_uuid)['Value']
-            xenapi.VDI.resize(self.xensession, vdi_uuid, self.hddsize)
-        else:
-            # otherwise create a disk of the requested size
-            log.info("Building a(n) %sGB disk" % int(self.hddsize / 1024 / 1024 / 1024))
-            vdi = { 'read_only' : False ,
-                    'sharable' : True ,
-                    'SR' : str(xenapi.SR.get_by_name_label(self.xensession, self.aggr)['Value'][0]) ,
-                    'name_label' : '/dev/xvda' ,
-                    'name_description' : '/dev/xvda on ' + self.name ,
-                    'virtual_size' : str(int(self.hddsize)) ,
-                    'type' : 'system',
-                    'other_config': { 'location': '/dev/xvda' } ,
-                  }
-
-            log.debug("VDI configuration: %s" % vdi)
-            try:
-                vdi_uuid = xenapi.VDI.create(self.xensession, vdi)['Value']
-            except:
-                print "Unable to create disk"
+            for disk in disks:
+                disk_labels.append('resize %s' % disk)
+                tasks.submit('resize %s' % disk, 'VDI.resize', disk, str(int(self.hddsize)))
+        elif 'disk-sized' not in self.steps:
+            # otherwise plug a disk of the requested size into the VM
+            if not vdi_uuid:
+                log.info("Building a(n) %sGB disk" % int(self.hddsize / 1024 / 1024 / 1024))
+                tasks.submit('vdi', 'VDI.create', self._vdi_record())
+                vdi_uuid = tasks.wait()['vdi']
+                self._record('vdi-created', vdi_uuid)
+            elif self.image and self.hddsize > self._image_size(vdi_uuid):
+                # grow the clone before anything is plugged into it
+                log.info("Resizing VM disk to %sGB" % int(self.hddsize / 1024 / 1024 / 1024))
+                tasks.submit('resize', 'VDI.resize', vdi_uuid, str(int(self.hddsize)))
+                tasks.wait()
             log.info("VDI uuid is %s" % vdi_uuid)
-            
+
             # create a VBD to plug the VDI into the VM
             vbd = { 'VDI' : vdi_uuid,
                     'VM' : self.vm_uuid,
@@ -339,79 +515,159 @@ class XenVM(VM):
                     'qos_algorithm_params': {},
                   }
             log.debug("VBD configuration: %s" % vbd)
-            vbd_uuid = xenapi.VBD.create(self.xensession, vbd)['Value']
-            log.info("VBD uuid is %s" % vbd_uuid)
-
-        # start the vm, if desired.
-        if self.autostart:
-            xenapi.VM.power_state_reset(self.xensession, self.vm_uuid)
-            self.start()
-        else:
-            xenapi.VM.power_state_reset(self.xensession, self.vm_uuid)
-
-    def start(self):
-        log.info('Booting %s' % self.name)
+            disk_labels.append('vbd')
+            tasks.submit('vbd', 'VBD.create', vbd)
 
+        disk_span = instrument.span('disk and VIF', vm=self.name)
         try:
-            xenapi.VM.start(self.xensession, vm_uuid, True, True)
-        except:
-            log.info('First attempt to start VM has FAILED. Will try 2 more times...')
+            results = tasks.wait()
+        finally:
+            disk_span.end()
+            # journal whatever got done, even if the rest failed
+            if 'vif' in tasks.results:
+                self._record('vif-created', tasks.results['vif'])
+            if disk_labels and not [label for label in disk_labels if label not in tasks.results]:
+                self._record('disk-sized')
+        if 'vbd' in results:
+            log.info("VBD uuid is %s" % results['vbd'])
+        vif_uuid = results.get('vif') or self.steps['vif-created']
+        if not self.mac_addr:
+            # no MAC was allocated up front, so xapi picked one
+            self.mac_addr = self.xenapi.VIF.get_record(self.xensession, vif_uuid)['Value']['MAC']
+        log.info("VIF uuid is %s (MAC %s)" % (vif_uuid, self.mac_addr))
+
+        # the boot scheduler starts the vm, if desired.
+        self.xenapi.VM.power_state_reset(self.xensession, self.vm_uuid)
+
+    def create_from_warm(self, warm):
+        """ make a claimed warm pool VM this VM.  its clone, disk and VIF are
+            there already, so this is a batch of metadata calls, and a resize
+            if this VM asked for a bigger disk than its type has """
+        log.info('Creating VM %s from warm pool VM %s' % (self.name, warm.vm))
+        self.vm_uuid = warm.vm
+        template_record = self.xencache._get_all_vm_records()[self.xencache.get_template(self.vm_template)]
+        batch = XenBatch(self.xenapi, self.xensession)
+        self._add_settings(batch, template_record)
+        batch.add('VDI description', 'VDI.set_name_description', warm.vdi, '/dev/xvda on %s' % self.name)
+        self._send_settings(batch)
+
+        if self.hddsize > warm.disk_size and 'disk-sized' not in self.steps:
+            log.info("Resizing VM disk to %sGB" % int(self.hddsize / 1024 / 1024 / 1024))
+            tasks = XenTasks(self.xenapi, self.xensession)
+            tasks.submit('resize', 'VDI.resize', warm.vdi, str(int(self.hddsize)))
+            disk_span = instrument.span('disk', vm=self.name)
             try:
-                xenapi.VM.start(self.xensession, vm_uuid, True, True)
-            except:
-                log.info('Second attempt to start VM has FAILED.  Will try 1 more time...')
-                try:
-                    xenapi.VM.start(self.xensession, vm_uuid, True, True)
-                except:
-                    log.warn('Unable to start VM')
-                    pass
+                tasks.wait()
+            finally:
+                disk_span.end()
+        self._record('disk-sized')
+        log.info("VIF uuid is %s (MAC %s)" % (warm.vif, self.mac_addr))
+
+    def reconcile(self, vm, cblr=None):
+        """ bring the existing VM vm in line with this VM's settings by changing
+            only what differs: vcpus, memory, a disk that is too small and the
+            cobbler mgmt_classes.  everything is read in one batch, and the
+            writes, disk resize and cobbler edit all go out together.
+
+            vcpus above VCPUs_max and memory limits can only be changed on a
+            halted VM, and a disk can not shrink, so those are left alone.
+            returns (what was changed, what still differs) """
+        self.vm_uuid = vm
+        batch = XenBatch(self.xenapi, self.xensession)
+        batch.add('record', 'VM.get_record', vm)
+        batch.add('VBDs', 'VBD.get_all_records_where', 'field "VM" = "%s" and field "type" = "Disk"' % vm)
+        results = batch.send()
+        record = results['record']
+        running = record['power_state'] != 'Halted'
+        # the system disk is the first one, as create() plugs it in
+        vbds = sorted(results['VBDs'].values(), key=lambda vbd: vbd['userdevice'])
+        if vbds:
+            batch.add('disk size', 'VDI.get_virtual_size', vbds[0]['VDI'])
+            results = batch.send()
+        system = cblr and cblr.get_system(self.fqdn)
+
+        changed, remaining = [], []
+        tasks = XenTasks(self.xenapi, self.xensession)
+
+        vcpus = int(self.vcpus)
+        vcpus_max, vcpus_at_startup = int(record['VCPUs_max']), int(record['VCPUs_at_startup'])
+        # lowering VCPUs_max needs a halt, so a running VM with room to spare is as good as done
+        if vcpus_at_startup != vcpus or (vcpus_max != vcpus and not running):
+            change = 'vcpus %i -> %i' % (vcpus_at_startup, vcpus)
+            if not running:
+                # at_startup may never be above max, so raise max first and lower it last
+                if vcpus > vcpus_max:
+                    batch.add('vcpus max', 'VM.set_VCPUs_max', vm, str(vcpus))
+                batch.add('vcpus at startup', 'VM.set_VCPUs_at_startup', vm, str(vcpus))
+                if vcpus < vcpus_max:
+                    batch.add('vcpus max', 'VM.set_VCPUs_max', vm, str(vcpus))
+                changed.append(change)
+            elif vcpus <= vcpus_max:
+                batch.add('vcpus live', 'VM.set_VCPUs_number_live', vm, str(vcpus))
+                batch.add('vcpus at startup', 'VM.set_VCPUs_at_startup', vm, str(vcpus))
+                changed.append(change)
+            else:
+                remaining.append('%s needs the VM halted' % change)
+
+        vram = int(self.vram)
+        # the four limits as set_memory_limits would leave them, against what they are now
+        dynamic_min = min(int(record['memory_dynamic_min']), vram)
+        static_min = min(int(record['memory_static_min']), dynamic_min)
+        limits = [static_min, vram, dynamic_min, vram]
+        current = [int(record[limit]) for limit in ('memory_static_min', 'memory_static_max', 'memory_dynamic_min', 'memory_dynamic_max')]
+        if current != limits:
+            if current[1] != vram:
+                change = 'memory %iMB -> %iMB' % (current[1] / 1024 / 1024, vram / 1024 / 1024)
+            else:
+                change = 'memory limits %s -> %s' % ('/'.join(['%iMB' % (limit / 1024 / 1024) for limit in current]),
+                                                     '/'.join(['%iMB' % (limit / 1024 / 1024) for limit in limits]))
+            if not running:
+                batch.add('memory', 'VM.set_memory_limits', vm, str(static_min), str(vram), str(dynamic_min), str(vram))
+                changed.append(change)
+            else:
+                remaining.append('%s needs the VM halted' % change)
+
+        if 'disk size' in results:
+            disk_size = int(results['disk size'])
+            change = 'disk %iGB -> %iGB' % (disk_size / self._gig, self.hddsize / self._gig)
+            if disk_size < self.hddsize:
+                tasks.submit('resize', running and 'VDI.resize_online' or 'VDI.resize', vbds[0]['VDI'], str(int(self.hddsize)))
+                changed.append(change)
+            elif disk_size > self.hddsize:
+                remaining.append('%s can not shrink, rebuild it with -r' % change)
+
+        mgmt_classes = (self.mgmt_classes or '').split()
+        if system is None and cblr:
+            remaining.append('%s is not in cobbler' % self.fqdn)
+        elif system is not None:
+            system_classes = system.get('mgmt_classes') or []
+            if isinstance(system_classes, basestring):
+                system_classes = system_classes.split()
+            if sorted(system_classes) != sorted(mgmt_classes):
+                changed.append('mgmt_classes %s -> %s' % (' '.join(system_classes) or 'none', ' '.join(mgmt_classes) or 'none'))
+                if self.image:
+                    # a VM built from an image learns them from xenstore
+                    batch.add('remove identity', 'VM.remove_from_xenstore_data', vm, 'vm-data/mgmt_classes')
+                    batch.add('identity', 'VM.add_to_xenstore_data', vm, 'vm-data/mgmt_classes', ' '.join(mgmt_classes))
+            else:
+                system = None
+
+        if batch.calls:
+            try:
+                self._send_settings(batch)
+            except XenTaskError:
+                tasks.wait(ignore_errors=True)
+                raise
+        if system is not None:
+            cblr.modify_system_fields(self.fqdn, [('mgmt_classes', self.mgmt_classes or '')])
+        tasks.wait()
+        return changed, remaining
 
     def is_existing_vm(self):
         """ check if a VM of the same name already exists """
-        self.existing_vm = []
-        for vm in self.xencache._get_all_vm_records():
-            if self.xencache._get_all_vm_records()[vm]['name_label'] == self.name:
-                self.existing_vm.append(vm)
-        
+        self.existing_vm = self.xencache.find_vms(self.name)
         return self.existing_vm
 
-    def _find_best_aggr(self):
-        """ probe available shared storage and determine which has the most free space """
-        log.debug("in find_best_aggr()")
-        log.info('Storage UUID: %s' % self.sr_aggr())
-
-        if self.xencache._get_shared_storage:
-            sr_attrib = {}
-            for sr in self.xencache._get_shared_storage():
-                
-                sruuid = xenapi.SR.get_by_name_label(self.xensession, sr)['Value'][0]
-                srname = sr
-                
-		srphysusage = xenapi.SR.get_record(self.xensession, sruuid)['Value']['physical_utilisation']
-                srphysusage = float(srphysusage)
-                log.debug("%s's usage is %s" % (srname, srphysusage))
-                
-                srphyssize = self.xencache._get_all_sr_records()[sruuid]['physical_size']
-                srphyssize = float(srphyssize)
-                
-                log.debug("%s's size is %s" % (srname, srphyssize))
-
-                srusage = srphysusage / srphyssize
-                log.debug("%s's usage ratio is %s" % (srname, srusage))
-                sr_attrib[srusage] = srname
-
-            best_aggr = sr_attrib[min(sr_attrib)]
-            log.info('Best aggr is %s' % best_aggr)
-            log.debug(sr_attrib)
-            return best_aggr
-        else:
-            log.warn("Unable to determine storage repository")
-            return None
-
-    def mac_addr():
-        """ return the mac address of the VM """
-        return self.mac_addr
-
     def fqdn():
         """ return FQDN of the VM """
         return self.fqdn
@@ -421,14 +677,25 @@ class ConfigFile:
     filename = None
     configparser = None
 
-    def __init__(self, filename):
+    def __init__(self, filename, contents=None):
+        """ contents, if given, is the text of filename, which is then not read from disk """
         self.filename = filename
-        self.configparser = self._get_config(filename)
+        self.configparser = self._get_config(filename, contents)
+        if contents is None:
+            try:
+                contents = open(filename).read()
+            except IOError:
+                contents = ''
+        # the step journal tells runs of the same file apart from runs of an edited one
+        self.digest = hashlib.sha1(contents).hexdigest()
 
-    def _get_config(self, myfile):
+    def _get_config(self, myfile, contents=None):
         log.debug("in get_config()")
         config = ConfigParser.ConfigParser()
-        config.read(myfile)
+        if contents is None:
+            config.read(myfile)
+        else:
+            config.readfp(StringIO(contents), myfile)
         return config
 
     def get_item(self, cfgitem, section="default", hard_fail=False):
@@ -452,28 +719,473 @@ class ConfigFile:
         return item
 
 
+class MacAllocator:
+    """ hand out MAC addresses before the VIFs exist, so cobbler can be given the
+        address when the system is first registered.  addresses are picked at
+        random from the configured range (which keeps concurrent mkvm runs from
+        walking the same sequence) and checked against every VIF in the pool,
+        and every system in cobbler if there is a CobblerCache """
+
+    def __init__(self, xencache, oui='00:16:3e', mac_range='00:00:00-ff:ff:ff', systems=None):
+        self.lock = threading.Lock()
+        self.oui = oui.lower()
+        first, last = mac_range.split('-')
+        self.first = int(first.replace(':', ''), 16)
+        self.last = int(last.replace(':', ''), 16)
+        self.xencache = xencache
+        self.systems = systems
+        self.in_use = set()
+
+    def _format(self, nic):
+        return '%s:%02x:%02x:%02x' % (self.oui, (nic >> 16) & 0xff, (nic >> 8) & 0xff, nic & 0xff)
+
+    def allocate(self):
+        """ reserve and return a MAC address nobody in the pool is using """
+        log.debug("in allocate()")
+        self.lock.acquire()
+        try:
+            start = random.randint(self.first, self.last)
+            size = self.last - self.first + 1
+            # a random pick almost always hits a free address.  if the range is
+            # crowded, walk it from there so a free address is always found.
+            for offset in xrange(0, size):
+                mac = self._format(self.first + (start - self.first + offset) % size)
+                if mac not in self.in_use and not self.xencache.mac_in_use(mac) and not (self.systems and self.systems.mac_in_use(mac)):
+                    self.in_use.add(mac)
+                    log.debug("allocated MAC %s" % mac)
+                    return mac
+        finally:
+            self.lock.release()
+        raise ValueError("no free MAC addresses left in %s:%s" % (self.oui, '-'.join([self._format(self.first)[9:], self._format(self.last)[9:]])))
+
+
+class Placement:
+    """ where one VM goes: the SR for its new disk and the host it should boot
+        on, or why it fits nowhere.  a VM built from a golden image also gets
+        the copy of the image on that SR, and the image's size """
+
+    def __init__(self, sr=None, host=None, disk=0, memory=0, error=None, image_vdi=None, image_size=0):
+        self.sr = sr
+        self.host = host
+        self.disk = disk
+        self.memory = memory
+        self.error = error
+        self.image_vdi = image_vdi
+        self.image_size = image_size
+
+
+def spread(candidates):
+    """ the SR or host with the largest share of it still free """
+    return max(candidates, key=lambda c: c[0] / max(c[1], 1))[2]
+
+
+def pack(candidates):
+    """ the SR or host with the least free space left that still fits """
+    return min(candidates)[2]
+
+
+def weighted(candidates):
+    """ a random pick, weighted by free space.  keeps concurrent mkvm runs
+        that see the same numbers from all choosing the same SR """
+    pick = random.uniform(0, sum([c[0] for c in candidates]))
+    for free, size, ref in candidates:
+        pick -= free
+        if pick <= 0:
+            return ref
+    return candidates[-1][2]
+
+
+placement_strategies = { 'spread' : spread,
+                         'pack' : pack,
+                         'weighted' : weighted,
+                       }
+
+
+class PlacementPlanner:
+    """ place a whole batch of VMs before any of them is created.  free space
+        on the shared SRs and free memory on the hosts (host_metrics) is
+        fetched once per batch, and every VM placed is reserved against it,
+        so a batch does not pile onto whichever SR looked emptiest.  VMs
+        that fit nowhere are known before anything is cloned.  a VM built
+        from a golden image can only go on an SR that holds a copy of it,
+        since VDI.clone does not cross SRs.
+
+        a strategy picks one of the candidates that fit, each given as
+        (free, size, ref).  reservations stay until release(), so the
+        batches a daemon plans while others are still running see each
+        other's VMs too """
+
+    def __init__(self, xencache, strategy='spread'):
+        if strategy not in placement_strategies:
+            raise ValueError("unknown placement strategy '%s', expected one of %s" % (strategy, ', '.join(sorted(placement_strategies))))
+        self.xencache = xencache
+        self.strategy = placement_strategies[strategy]
+        self.lock = threading.Lock()
+        self.reserved = {}
+
+    def _capacity(self, images=()):
+        """ (free, size) of every shared SR by name and of every enabled host by
+            ref, and for each of images, the (VDI, size) of its copy on each SR """
+        shared_storage = self.xencache._get_shared_storage()
+        sr_records = self.xencache._get_all_sr_records()
+        self.xencache.lock.acquire()
+        try:
+            batch = XenBatch(self.xencache.xenapi, self.xencache.xensession)
+            for name in shared_storage:
+                batch.add(name, 'SR.get_physical_utilisation', self.xencache.get_sr(name))
+            batch.add('hosts', 'host.get_all_records')
+            batch.add('host metrics', 'host_metrics.get_all_records')
+            for image in images:
+                batch.add('image %s' % image, 'VDI.get_all_records_where', self.xencache._where('name__label', [image]))
+            results = batch.send(ignore_errors=True)
+        finally:
+            self.xencache.lock.release()
+
+        golden = {}
+        for image in images:
+            golden[image] = {}
+            for vdi, record in results.get('image %s' % image, {}).items():
+                if record['SR'] in sr_records and not record.get('is_a_snapshot'):
+                    golden[image][sr_records[record['SR']]['name_label']] = (vdi, int(record['virtual_size']))
+
+        storage = {}
+        for name in shared_storage:
+            if name in results:
+                size = float(sr_records[self.xencache.get_sr(name)]['physical_size'])
+                storage[name] = [size - float(results[name]), size, sr_records[self.xencache.get_sr(name)]['type']]
+
+        hosts = {}
+        metrics = results.get('host metrics', {})
+        for host, record in results.get('hosts', {}).items():
+            if record.get('enabled') and record.get('metrics') in metrics:
+                host_metrics = metrics[record['metrics']]
+                hosts[host] = [float(host_metrics['memory_free']), float(host_metrics['memory_total'])]
+        if 'hosts' in batch.errors or 'host metrics' in batch.errors:
+            log.warn("unable to read host memory, placing on storage only: %s" % (batch.errors.get('hosts') or batch.errors.get('host metrics')))
+        return storage, hosts, golden
+
+    def plan(self, requests, headroom=0.0):
+        """ requests are (key, storage type, disk bytes, memory bytes, golden
+            image or None), with no memory for VMs that will not be booted.
+            an SR is only used if at least a headroom share of it is left
+            free afterwards.  returns a Placement for every key """
+        self.lock.acquire()
+        try:
+            storage, hosts, golden = self._capacity(sorted(set([r[4] for r in requests if r[4]])))
+            for placement in self.reserved.values():
+                if placement.sr in storage:
+                    storage[placement.sr][0] -= placement.disk
+                if placement.host in hosts:
+                    hosts[placement.host][0] -= placement.memory
+
+            placements = {}
+            # biggest disks first, so the small ones fill in the gaps they leave
+            for key, storage_type, disk, memory, image in sorted(requests, key=lambda r: -r[2]):
+                srs = [(free, size, name) for name, (free, size, sr_type) in storage.items() if storage_type in (None, sr_type) and free - disk >= headroom * size]
+                if image:
+                    srs = [sr for sr in srs if sr[2] in golden[image]]
+                if not srs:
+                    if image and not golden[image]:
+                        placements[key] = Placement(error="there is no golden image named '%s' on the shared storage" % image)
+                    else:
+                        placements[key] = Placement(error="no %s storage%s with %iGB free" % (storage_type, image and ' holding %s' % image or '', disk / 1024 ** 3))
+                    continue
+                host = None
+                if memory and hosts:
+                    fits = [(free, size, ref) for ref, (free, size) in hosts.items() if free >= memory]
+                    if not fits:
+                        placements[key] = Placement(error="no host with %.1fGB of memory free" % (memory / float(1024 ** 3)))
+                        continue
+                    host = self.strategy(fits)
+                    hosts[host][0] -= memory
+
+                sr = self.strategy(srs)
+                storage[sr][0] -= disk
+                placements[key] = self.reserved[key] = Placement(sr, host, disk, memory)
+                if image:
+                    placements[key].image_vdi, placements[key].image_size = golden[image][sr]
+                log.info("placing %s on %s%s" % (key, sr, host and ' and host %s' % host or ''))
+            return placements
+        finally:
+            self.lock.release()
+
+    def release(self, key):
+        """ the VM for key has been created (or given up on), so its disk and memory show in the pool's numbers """
+        self.lock.acquire()
+        try:
+            self.reserved.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def plan_jobs(self, jobs, tmpl):
+        """ place every job that creates a VM, setting job.placement """
+        requests = []
+        for job in jobs:
+            if job.options.destroy:
+                continue
+            vm = XenVM(job.vmname, self.xencache, None, None)
+            try:
+                vm.configure(job.cfg, tmpl, '')
+            except Exception, e:
+                # provisioning will fail on the same thing, with a better message
+                log.debug("unable to place %s: %s" % (job.vmname, e))
+                continue
+            requests.append((job, vm.storage, int(vm.hddsize), job.options.autostart and int(vm.vram) or 0, vm.image))
+        for job, placement in self.plan(requests).items():
+            job.placement = placement
+
+
+class WarmVM:
+    """ a warm pool VM someone has claimed, with its disk and network card """
+
+    def __init__(self, vm, vdi, disk_size, vif, mac):
+        self.vm = vm
+        self.vdi = vdi
+        self.disk_size = disk_size
+        self.vif = vif
+        self.mac = mac
+
+
+class WarmPool:
+    """ VMs of each type in warm_pool that are cloned, given a disk of the
+        type's size and a VIF, and left powered off and hidden, so creating a
+        VM of that type only has to claim one and give it its settings.
+
+        a warm VM is named mkvm-warm-<type> and tagged mkvm-warm=<type> in
+        other_config.  claims are atomic across every mkvm talking to the
+        pool: add_to_other_config fails with MAP_DUPLICATE_KEY for everyone
+        but the first to add mkvm-claimed. """
+
+    def __init__(self, xencache, tmpl, sizes):
+        self.xencache = xencache
+        self.tmpl = tmpl
+        self.sizes = sizes
+        self.lock = threading.Lock()
+        self.claimed = set()
+        # set when a VM is claimed, so a WarmPoolFiller can stage its replacement
+        self.drained = threading.Event()
+        self.types = {}
+        for vmtype in sizes:
+            self.types[vmtype] = XenVM(self.vm_name(vmtype), xencache, None, None)
+            self.types[vmtype].configure_warm(tmpl, vmtype)
+
+    def vm_name(self, vmtype):
+        return 'mkvm-warm-%s' % vmtype
+
+    def available(self, vmtype):
+        """ the unclaimed warm VMs of vmtype, as far as the XenCache knows """
+        records = self.xencache._get_all_vm_records()
+        self.lock.acquire()
+        try:
+            return [ref for ref in self.xencache.find_vms(self.vm_name(vmtype)) if ref not in self.claimed
+                    and records[ref]['other_config'].get('mkvm-warm') == vmtype
+                    and 'mkvm-claimed' not in records[ref]['other_config']
+                    and records[ref]['power_state'] == 'Halted']
+        finally:
+            self.lock.release()
+
+    def _fits(self, myvm):
+        """ whether a warm VM of myvm's type can become myvm """
+        warm = self.types.get(myvm.vmtype)
+        if warm is None:
+            return False
+        # a disk can grow on claim, but not shrink
+        return (myvm.vm_template, myvm.image, myvm.storage) == (warm.vm_template, warm.image, warm.storage) and myvm.hddsize >= warm.hddsize
+
+    def claim(self, myvm, xenapi, xensession):
+        """ claim a warm VM that can become myvm.  returns a WarmVM, or None
+            if there is none to be had """
+        if not self._fits(myvm):
+            return None
+        candidates = self.available(myvm.vmtype)
+        # claimers starting from different ends of the list collide less
+        random.shuffle(candidates)
+        for vm in candidates:
+            self.lock.acquire()
+            try:
+                if vm in self.claimed:
+                    continue
+                self.claimed.add(vm)
+            finally:
+                self.lock.release()
+            claim = xenapi.VM.add_to_other_config(xensession, vm, 'mkvm-claimed', '%s:%i %s %s' % (socket.gethostname(), os.getpid(), myvm.name, strftime("%Y-%m-%d %H:%M:%S")))
+            if claim['Status'] != 'Success':
+                log.debug("warm VM %s was claimed by someone else: %s" % (vm, claim['ErrorDescription']))
+                continue
+
+            batch = XenBatch(xenapi, xensession)
+            batch.add('VBDs', 'VBD.get_all_records_where', 'field "VM" = "%s"' % vm)
+            batch.add('VIFs', 'VIF.get_all_records_where', 'field "VM" = "%s"' % vm)
+            results = batch.send()
+            disks = [vbd['VDI'] for vbd in results['VBDs'].values() if vbd['type'] == 'Disk']
+            if not disks or not results['VIFs']:
+                log.warn("warm VM %s has no disk or no VIF, leaving it claimed" % vm)
+                continue
+            vif, vif_record = results['VIFs'].items()[0]
+            self.drained.set()
+            log.info("claimed warm VM %s for %s" % (vm, myvm.name))
+            return WarmVM(vm, disks[0], self.types[myvm.vmtype].hddsize, vif, vif_record['MAC'])
+        return None
+
+
+class WarmPoolFiller(threading.Thread):
+    """ stage new warm VMs whenever the pool runs low, one at a time and on
+        its own XenAPI session, so it never holds up a create.  warm VMs are
+        placed by the PlacementPlanner like any other VM, and only on SRs
+        that keep a headroom share free afterwards """
+
+    def __init__(self, pool, planner, macs, connect, headroom=0.2, interval=60):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.pool = pool
+        self.planner = planner
+        self.macs = macs
+        self.connect = connect
+        self.headroom = headroom
+        self.interval = interval
+        self.xenapi = None
+        self.xensession = None
+
+    def stage(self, vmtype):
+        """ build one warm VM of vmtype.  returns False if there is no room for it """
+        xencache = self.pool.xencache
+        myvm = XenVM(self.pool.vm_name(vmtype), xencache, self.xenapi, self.xensession)
+        myvm.configure_warm(self.pool.tmpl, vmtype)
+        myvm.sr_aggr = xencache._get_shared_storage
+        placement = self.planner.plan([(myvm.name, myvm.storage, int(myvm.hddsize), 0, myvm.image)], self.headroom)[myvm.name]
+        if placement.error:
+            log.info("not staging a warm %s VM: %s" % (vmtype, placement.error))
+            return False
+        try:
+            myvm.placement = placement
+            myvm.mac_addr = self.macs.allocate()
+            myvm.create()
+            xencache.add_vm(myvm.vm_uuid, self.xenapi.VM.get_record(self.xensession, myvm.vm_uuid)['Value'])
+        finally:
+            self.planner.release(myvm.name)
+        return True
+
+    def fill(self):
+        """ stage warm VMs until every type has as many as it should """
+        for vmtype, size in sorted(self.pool.sizes.items()):
+            while len(self.pool.available(vmtype)) < size:
+                if not self.stage(vmtype):
+                    break
+
+    def run(self):
+        while True:
+            try:
+                if self.xensession is None:
+                    self.xenapi, self.xensession = self.connect()[:2]
+                self.fill()
+            except Exception, e:
+                log.error("staging warm pool VMs failed: %s" % e)
+                log.debug(traceback.format_exc())
+                self.xensession = None
+            self.pool.drained.wait(self.interval)
+            self.pool.drained.clear()
+
+
+def intern_value(value):
+    """ intern the strings in a XenAPI value, so the names, types and refs that
+        repeat across thousands of records are only kept in memory once """
+    if type(value) is str:
+        return intern(value)
+    elif type(value) is unicode:
+        # JSON-RPC returns every string as unicode
+        try:
+            return intern(str(value))
+        except UnicodeEncodeError:
+            return value
+    elif type(value) is list:
+        return [intern_value(v) for v in value]
+    elif type(value) is dict:
+        return dict([(intern_value(k), intern_value(v)) for k, v in value.items()])
+    return value
+
+
+class CompactRecord(object):
+    """ the few fields of a XenAPI record that mkvm actually reads, in slots
+        instead of a dict.  it can still be read like the record dict it replaces """
+
+    __slots__ = ()
+
+    def __init__(self, record):
+        for field in self.__slots__:
+            setattr(self, field, intern_value(record.get(field)))
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def __contains__(self, field):
+        return field in self.__slots__
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+    def __repr__(self):
+        return repr(dict([(field, getattr(self, field)) for field in self.__slots__]))
+
+
+class VMRecord(CompactRecord):
+    __slots__ = ('uuid', 'name_label', 'is_a_template', 'is_a_snapshot', 'is_control_domain', 'power_state', 'VBDs', 'VIFs', 'other_config',
+                 'memory_static_min', 'memory_dynamic_min')
+
+
+class SRRecord(CompactRecord):
+    __slots__ = ('uuid', 'name_label', 'type', 'shared', 'physical_size', 'physical_utilisation', 'virtual_allocation')
+
+
+class VIFRecord(CompactRecord):
+    __slots__ = ('uuid', 'MAC', 'VM')
+
+
 class XenCache:
-    """ stuff that needs to be 'discovered' once, then cached for future use """
+    """ stuff that needs to be 'discovered' once, then cached for future use.
+
+        each collection (VMs, SRs, VIFs) is fetched the first time something
+        asks for it, so a run only pays for the data it actually touches.  how
+        long each one took is logged and kept in timings.
+
+        given a snapshot file, the records are kept on disk between runs along
+        with an event.from token per collection.  the next run only asks
+        XenServer for what changed since that token, and falls back to fetching
+        everything when the token is no longer valid.
+
+        given a list of VM names instead, only those VMs, the templates they
+        may be cloned from and the shared SRs of the configured storage types
+        are fetched, using get_all_records_where so xapi does the filtering.
+        in that mode VIFs are looked up by MAC only when one is needed, and the
+        FQDN index only covers the VMs that were fetched.
+
+        records are kept as VMRecord/SRRecord/VIFRecord, which hold only the
+        fields mkvm reads. """
 
     sr_aggr = None
     vm_templates = None
     all_vm_records = None
-    vm_records = None
+    all_sr_records = None
+    all_vif_records = None
+
+    # event.from class name -> attribute holding that class' records
+    event_classes = { 'vm' : 'all_vm_records',
+                      'sr' : 'all_sr_records',
+                      'vif' : 'all_vif_records',
+                    }
+    record_classes = { 'vm' : VMRecord,
+                       'sr' : SRRecord,
+                       'vif' : VIFRecord,
+                     }
+    snapshot_version = 4
 
     def _query_xen_templates(self):
-        """ probe the xenserver for available templates to use """
+        """ the templates available to clone, by name """
         log.debug('in _find_xen_templates')
-        
-        log.info('scanning all templates in XenServer')
-        template_uuids = {}
-        for uuid in self.all_vm_records:
-            for key in self.all_vm_records[uuid]:
-                if 'is_a_template' in key and self.all_vm_records[uuid]['is_a_template']:
-                    uuid_name_label = self.all_vm_records[uuid]['name_label']
-                    templates = { uuid_name_label : uuid }
-        templates = {}
-        log.debug(templates)
-        return templates
+        log.debug(self.vm_templates)
+        return self.vm_templates
 
     def _query_shared_storage(self):
         """ probe for available storage backends """
@@ -483,7 +1195,7 @@ class XenCache:
         self.sr_aggr = {}
         for sr in self.all_sr_records:
             if 'shared' in self.all_sr_records[sr] and self.all_sr_records[sr]['shared']:
-                if self.all_sr_records[sr]['type'] == 'lvmoiscsi' or self.all_sr_records[sr]['type'] == 'netapp':
+                if self.all_sr_records[sr]['type'] in self.storage_types:
                     self.sr_aggr[self.all_sr_records[sr]['name_label']] = self.all_sr_records[sr]['uuid']
 
         log.info("Shared storage repositories found: %s" % self.sr_aggr)
@@ -493,7 +1205,7 @@ class XenCache:
         """ cache all the storage repository records, so we don't have to query XenServer for them multiple times """
         log.debug("in _get_sr_records()")
         
-        sr_records = xenapi.SR.get_all_records(self.xensession)['Value']
+        sr_records = self.xenapi.SR.get_all_records(self.xensession)['Value']
         log.debug("found SR records: %s" % sr_records)
         return sr_records
         
@@ -501,28 +1213,325 @@ class XenCache:
         """ cache all the VM records, so we don't have to query XenServer for them multiple times """
         log.debug("in _get_vm_records()")
         
-        vm_records = xenapi.VM.get_all_records(self.xensession)['Value']
+        vm_records = self.xenapi.VM.get_all_records(self.xensession)['Value']
         log.debug("found VM records: %s" % vm_records)
         return vm_records
 
+    def _query_vif_records(self):
+        """ cache all the VIF records, so new MAC addresses can be checked against the ones in use """
+        log.debug("in _get_vif_records()")
+
+        vif_records = self.xenapi.VIF.get_all_records(self.xensession)['Value']
+        log.debug("found %i VIF records" % len(vif_records))
+        return vif_records
+
+    def _where(self, field, values):
+        """ a get_all_records_where expression matching any of values """
+        return ' or '.join(['field "%s" = "%s"' % (field, str(value).replace('"', '\\"')) for value in values])
+
+    def _fetch_narrow(self, cls):
+        """ fetch only the records of cls this run can possibly need """
+        log.debug("in _fetch_narrow()")
+        if cls == 'vm':
+            return self.xenapi.VM.get_all_records_where(self.xensession, self._where('name__label', self.vm_names))['Value']
+        elif cls == 'sr':
+            return self.xenapi.SR.get_all_records_where(self.xensession, 'field "shared" = "true" and (%s)' % self._where('type', self.storage_types))['Value']
+        return {}
+
+    def _compact(self, cls, records):
+        """ project a get_all_records result onto the record class for cls """
+        record_class = self.record_classes[cls]
+        return dict([(intern_value(ref), record_class(record)) for ref, record in records.items()])
+
     def _get_shared_storage(self):
+        self._ensure('sr')
         return self.sr_aggr
 
     def _get_all_vm_records(self):
+        self._ensure('vm')
         return self.all_vm_records
 
     def _get_all_sr_records(self):
+        self._ensure('sr')
         return self.all_sr_records
 
+    def _get_all_vif_records(self):
+        self._ensure('vif')
+        return self.all_vif_records
+
     def _get_xen_templates(self):
+        self._ensure('vm')
         return self.vm_templates
 
-    def __init__(self, xensession):
+    def _index(self, cls, ref, record):
+        """ add one record to the lookup indexes """
+        if cls == 'vm':
+            self.vms_by_name.setdefault(record['name_label'], []).append(ref)
+            if record['is_a_template']:
+                self.vm_templates[record['name_label']] = ref
+            fqdn = record['other_config'].get('FQDN')
+            if fqdn:
+                self.vms_by_fqdn[fqdn] = ref
+        elif cls == 'sr':
+            self.srs_by_name[record['name_label']] = ref
+        elif cls == 'vif':
+            self.vifs_by_mac[record['MAC'].lower()] = ref
+
+    def _unindex(self, cls, ref, record):
+        """ take one record out of the lookup indexes """
+        if cls == 'vm':
+            refs = self.vms_by_name.get(record['name_label'], [])
+            if ref in refs:
+                refs.remove(ref)
+            if not refs:
+                self.vms_by_name.pop(record['name_label'], None)
+            if self.vm_templates.get(record['name_label']) == ref:
+                del self.vm_templates[record['name_label']]
+            if self.vms_by_fqdn.get(record['other_config'].get('FQDN')) == ref:
+                del self.vms_by_fqdn[record['other_config']['FQDN']]
+        elif cls == 'sr':
+            if self.srs_by_name.get(record['name_label']) == ref:
+                del self.srs_by_name[record['name_label']]
+        elif cls == 'vif':
+            if self.vifs_by_mac.get(record['MAC'].lower()) == ref:
+                del self.vifs_by_mac[record['MAC'].lower()]
+
+    def _build_indexes(self, cls):
+        """ hash VMs by name_label and FQDN, templates and SRs by name, VIFs by MAC """
+        log.debug("in _build_indexes()")
+        if cls == 'vm':
+            self.vms_by_name = {}
+            self.vms_by_fqdn = {}
+            self.vm_templates = {}
+        elif cls == 'sr':
+            self.srs_by_name = {}
+        elif cls == 'vif':
+            self.vifs_by_mac = {}
+        for ref, record in getattr(self, self.event_classes[cls]).items():
+            self._index(cls, ref, record)
+
+    def _store(self, cls, ref, record):
+        """ add or replace (or with None, drop) one record, keeping the indexes in step """
+        self.lock.acquire()
+        try:
+            records = getattr(self, self.event_classes[cls])
+            if ref in records:
+                self._unindex(cls, ref, records[ref])
+            if record is None:
+                records.pop(ref, None)
+            else:
+                if not isinstance(record, CompactRecord):
+                    record = self.record_classes[cls](record)
+                records[intern_value(ref)] = record
+                self._index(cls, ref, record)
+        finally:
+            self.lock.release()
+
+    def find_vms(self, name_label):
+        """ every VM (or template) called name_label """
+        self._ensure('vm')
+        return list(self.vms_by_name.get(name_label, []))
+
+    def mac_in_use(self, mac):
+        """ whether any VIF in the pool has this MAC address """
+        if self.vm_names is None:
+            self._ensure('vif')
+            return mac.lower() in self.vifs_by_mac
+        self.lock.acquire()
+        try:
+            return bool(self.xenapi.VIF.get_all_records_where(self.xensession, self._where('MAC', [mac.lower()]))['Value'])
+        finally:
+            self.lock.release()
+
+    def find_vm_by_fqdn(self, fqdn):
+        """ the VM mkvm tagged with this FQDN, if any """
+        self._ensure('vm')
+        return self.vms_by_fqdn.get(fqdn)
+
+    def get_template(self, name_label):
+        self._ensure('vm')
+        return self.vm_templates.get(name_label)
+
+    def get_sr(self, name_label):
+        self._ensure('sr')
+        return self.srs_by_name.get(name_label)
+
+    def add_vm(self, ref, record):
+        """ pick up a VM mkvm has just created """
+        if 'vm' in self.loaded:
+            self._store('vm', ref, record)
+
+    def remove_vm(self, ref):
+        """ forget a VM mkvm has just destroyed """
+        if 'vm' in self.loaded:
+            self._store('vm', ref, None)
+
+    def _event_from(self, cls, token):
+        """ everything of cls that changed since token (or everything, if token is empty) """
+        return getattr(self.xenapi.event, 'from')(self.xensession, [cls], token, 0.0)
+
+    def _apply_events(self, events):
+        for event in events:
+            if event['operation'] == 'del':
+                self._store(event['class'].lower(), event['ref'], None)
+            elif 'snapshot' in event:
+                self._store(event['class'].lower(), event['ref'], event['snapshot'])
+
+    def _read_snapshot(self):
+        """ read the records saved by the last run.  every collection in it that
+            has a token is kept in self.saved until it is first needed """
+        log.debug("in _read_snapshot()")
+        self.saved = {}
+        try:
+            snapshot_file = open(self.snapshot, 'rb')
+            try:
+                snapshot = cPickle.load(snapshot_file)
+            finally:
+                snapshot_file.close()
+        except Exception, e:
+            log.info("no usable XenCache snapshot in %s: %s" % (self.snapshot, e))
+            return
+
+        if snapshot.get('version') != self.snapshot_version:
+            log.info("ignoring XenCache snapshot %s from another mkvm version" % self.snapshot)
+            return
+        self.saved = snapshot['collections']
+
+    def _save_snapshot(self):
+        """ write the records and tokens out for the next run.  collections this
+            run never loaded are written back as they were read.  the file is
+            replaced atomically """
+        log.debug("in _save_snapshot()")
+        collections = dict(self.saved)
+        for cls in self.loaded:
+            if self.tokens.get(cls):
+                collections[cls] = (self.tokens[cls], getattr(self, self.event_classes[cls]))
+        snapshot = { 'version' : self.snapshot_version, 'collections' : collections }
+
+        try:
+            if not os.path.isdir(os.path.dirname(self.snapshot)):
+                os.makedirs(os.path.dirname(self.snapshot), 0700)
+            tmp = '%s.%i' % (self.snapshot, os.getpid())
+            snapshot_file = os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'wb')
+            try:
+                cPickle.dump(snapshot, snapshot_file, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                snapshot_file.close()
+            os.rename(tmp, self.snapshot)
+        except (IOError, OSError), e:
+            log.warn("unable to save XenCache snapshot %s: %s" % (self.snapshot, e))
+
+    def _fetch_all(self, cls):
+        """ fetch every record of cls.  event.from with an empty token returns them
+            all together with a token to refresh from next time """
+        setattr(self, self.event_classes[cls], {})
+        self._build_indexes(cls)
+        events = self._event_from(cls, '')
+        if events['Status'] == 'Success':
+            self._apply_events(events['Value']['events'])
+            self.tokens[cls] = events['Value']['token']
+        else:
+            log.debug("event.from is not available (%s)" % events['ErrorDescription'])
+            setattr(self, self.event_classes[cls], self._compact(cls, getattr(self, '_query_%s_records' % cls)()))
+            self._build_indexes(cls)
+            self.tokens[cls] = None
+
+    def _refresh(self, cls):
+        """ bring one collection up to date, incrementally when a token is known """
+        if self.vm_names is not None:
+            setattr(self, self.event_classes[cls], self._compact(cls, self._fetch_narrow(cls)))
+            self._build_indexes(cls)
+        else:
+            events = None
+            if self.tokens.get(cls):
+                events = self._event_from(cls, self.tokens[cls])
+            if events and events['Status'] == 'Success':
+                self._apply_events(events['Value']['events'])
+                self.tokens[cls] = events['Value']['token']
+                log.debug("applied %i %s changes" % (len(events['Value']['events']), cls))
+            else:
+                if events:
+                    log.info("XenCache %s token expired (%s), fetching everything" % (cls, ' '.join(events['ErrorDescription'])))
+                self._fetch_all(cls)
+
+        if cls == 'sr':
+            self.sr_aggr = self._query_shared_storage()
+        elif cls == 'vm':
+            self.vm_templates = self._query_xen_templates()
+
+    def _ensure(self, cls):
+        """ load cls the first time anybody needs it """
+        if cls in self.loaded:
+            return
+        self.lock.acquire()
+        try:
+            if cls in self.loaded:
+                return
+            start = time.time()
+            if self.snapshot and self.vm_names is None:
+                if self.saved is None:
+                    self._read_snapshot()
+                if cls in self.saved:
+                    self.tokens[cls], records = self.saved[cls]
+                    setattr(self, self.event_classes[cls], records)
+                    self._build_indexes(cls)
+            self._refresh(cls)
+            self.loaded.add(cls)
+            if self.snapshot and self.vm_names is None:
+                self._save_snapshot()
+            self.timings[cls] = time.time() - start
+            log.info("loaded %i %s records in %.2fs" % (len(getattr(self, self.event_classes[cls])), cls, self.timings[cls]))
+        finally:
+            self.lock.release()
+
+    def refresh(self, save=True):
+        """ bring every collection loaded so far up to date.  a long-running
+            process refreshing often passes save=False and calls save() itself """
+        log.debug("in refresh()")
+        self.lock.acquire()
+        try:
+            for cls in self.loaded:
+                self._refresh(cls)
+            if save:
+                self.save()
+        finally:
+            self.lock.release()
+
+    def save(self):
+        """ write the snapshot file, if there is one """
+        self.lock.acquire()
+        try:
+            if self.snapshot and self.vm_names is None:
+                self._save_snapshot()
+        finally:
+            self.lock.release()
+
+    def add_storage_types(self, storage_types):
+        """ also count shared SRs of these types as storage new VMs can go on """
+        self.lock.acquire()
+        try:
+            new_types = [t for t in storage_types if t not in self.storage_types]
+            if not new_types:
+                return
+            self.storage_types = tuple(self.storage_types) + tuple(new_types)
+            if 'sr' in self.loaded:
+                self._refresh('sr')
+        finally:
+            self.lock.release()
+
+    def __init__(self, xenapi, xensession, snapshot=None, vm_names=None, storage_types=None):
+        """ nothing is fetched here.  xenapi is only used while holding the
+            cache's lock, so workers can share the cache safely """
+        self.xenapi = xenapi
         self.xensession = xensession
-        self.all_sr_records = self._query_sr_records()
-        self.all_vm_records = self._query_vm_records()
-        self.vm_templates = self._query_xen_templates()
-        self.sr_aggr = self._query_shared_storage()
+        self.snapshot = snapshot
+        self.vm_names = vm_names
+        self.storage_types = storage_types or ('lvmoiscsi', 'netapp')
+        self.lock = threading.RLock()
+        self.loaded = set()
+        self.tokens = {}
+        self.timings = {}
+        self.saved = None
 
 
 class cobbler:
@@ -532,6 +1541,7 @@ class cobbler:
     cobbler_server = ''
     cobbler = ''
     token = ''
+    bulk_modes = ['multicall', 'xapi_object_edit', 'modify_system']
     
     def get_cobbler_server(self, cblr):
         """ connect to a cobbler xmlrpc api """
@@ -543,31 +1553,111 @@ class cobbler:
             url = "http://%s/cobbler_api" % cblr
             
         try:
+            if instrument.recorder:
+                transport = instrument.counting_transport(url)
+                return instrument.recorder.wrap(xmlrpclib.Server(url, transport=transport), 'cobbler', transport)
             server = xmlrpclib.Server(url)
             return server
         except:
             traceback.print_exc()
             sys.exit(-1)
 
+    def _system_fields(self, xenvm):
+        """ every field a new system gets, in the order they are set """
+        return [ ('name', xenvm.fqdn),
+                 ('hostname', xenvm.fqdn),
+                 ('profile', xenvm.cobbler_profile),
+                 ('ksmeta', xenvm.ksmeta),
+                 ('mgmt_classes', xenvm.mgmt_classes),
+                 ('modify_interface', xenvm.nics['eth0']),
+                 ('comment', 'Created by ' + xenvm.creator + ' using mkvm.py. ' + strftime("%Y-%m-%d %H:%M:%S")),
+                 # a VM built from a golden image is never kickstarted
+                 ('netboot_enabled', not xenvm.image),
+               ]
+
+    def _unsupported(self, fault):
+        """ whether a fault means the server does not have the method at all """
+        return 'not supported' in fault.faultString or 'unknown method' in fault.faultString.lower() or 'has no attribute' in fault.faultString
+
     def add_system_to_cobbler(self, xenvm):
         """ add the VM to cobbler """
         log.debug("in add_system_to_cobbler()")
 
         self.vm_id = self.cobbler.new_system(self.token)
-        self.cobbler.modify_system(self.vm_id, 'name', xenvm.fqdn, self.token)
-        self.cobbler.modify_system(self.vm_id, 'hostname', xenvm.fqdn, self.token)
-        self.cobbler.modify_system(self.vm_id, 'profile', xenvm.cobbler_profile, self.token)
-        self.cobbler.modify_system(self.vm_id, 'ksmeta', xenvm.ksmeta, self.token)
-        self.cobbler.modify_system(self.vm_id, 'mgmt_classes', xenvm.mgmt_classes, self.token)
-        self.cobbler.modify_system(self.vm_id, 'modify_interface', xenvm.nics['eth0'], self.token)
-        self.cobbler.modify_system(self.vm_id, 'comment', 'Created by ' + options.cblr_username + ' using mkvm.py. ' + strftime("%Y-%m-%d %H:%M:%S"), self.token)
+        for field, value in self._system_fields(xenvm):
+            self.cobbler.modify_system(self.vm_id, field, value, self.token)
         self.cobbler.save_system(self.vm_id, self.token)
 
-    def query_install_repo(self, vm_fqdn):
-        """ query the install repo from cobbler """
-        log.debug("in query_install_repo()")
-
-        sys_rendered = self.cobbler.get_system_for_koan(vm_fqdn)
+    def _register_multicall(self, xenvms):
+        """ two requests for the whole batch: one multicall for the handles, one for every field and save """
+        multicall = xmlrpclib.MultiCall(self.cobbler)
+        for xenvm in xenvms:
+            multicall.new_system(self.token)
+        handles = list(multicall())
+
+        multicall = xmlrpclib.MultiCall(self.cobbler)
+        calls = []
+        for xenvm, handle in zip(xenvms, handles):
+            for field, value in self._system_fields(xenvm):
+                multicall.modify_system(handle, field, value, self.token)
+                calls.append(xenvm)
+            multicall.save_system(handle, self.token)
+            calls.append(xenvm)
+
+        errors = {}
+        results = multicall()
+        for i in range(0, len(calls)):
+            try:
+                results[i]
+            except xmlrpclib.Fault, e:
+                errors.setdefault(calls[i].fqdn, e)
+        return errors
+
+    def _register_xapi_object_edit(self, xenvms):
+        """ one request per system, with every field in it """
+        errors = {}
+        for xenvm in xenvms:
+            try:
+                self.cobbler.xapi_object_edit('system', xenvm.fqdn, 'add', dict(self._system_fields(xenvm)), self.token)
+            except xmlrpclib.Fault, e:
+                if self._unsupported(e):
+                    raise
+                # most likely the system exists already.  the old way overwrites it, like mkvm always has.
+                log.debug("xapi_object_edit failed for %s (%s), falling back to modify_system" % (xenvm.fqdn, e.faultString))
+                errors.update(self._register_modify_system([xenvm]))
+        return errors
+
+    def _register_modify_system(self, xenvms):
+        """ new_system, a modify_system per field and save_system for each system """
+        errors = {}
+        for xenvm in xenvms:
+            try:
+                self.add_system_to_cobbler(xenvm)
+            except xmlrpclib.Fault, e:
+                errors[xenvm.fqdn] = e
+        return errors
+
+    def register_systems(self, xenvms):
+        """ add many systems to cobbler in as few requests as the server allows.
+            system.multicall is tried first, then xapi_object_edit (cobbler 2.2+),
+            then the field-by-field calls every cobbler has.  the first mode that
+            works is remembered.  returns {fqdn: fault} for systems that failed """
+        log.debug("in register_systems()")
+
+        while True:
+            mode = self.bulk_modes[0]
+            log.info("registering %i systems in cobbler using %s" % (len(xenvms), mode))
+            try:
+                return getattr(self, '_register_' + mode)(xenvms)
+            except xmlrpclib.Fault, e:
+                if len(self.bulk_modes) == 1 or not self._unsupported(e):
+                    raise
+                log.debug("cobbler does not support %s: %s" % (mode, e.faultString))
+                self.bulk_modes = self.bulk_modes[1:]
+
+    def _install_repo(self, sys_rendered):
+        """ the install tree among the source_repos of a koan rendering """
+        install_repo = None
         for x in sys_rendered:
             if 'source_repo' in x:
                 for y in sys_rendered[x]:
@@ -579,20 +1669,86 @@ class cobbler:
 
         return install_repo
 
-    def add_mac_to_cobbler(self, xenvm):
-        """ add the MAC address to cobbler.  this will be moved into a class later """
-        self.cobbler.modify_system(self.vm_id, 'modify_interface', xenvm.nics['eth0'], self.token)
-        self.cobbler.save_system(self.vm_id, self.token)
+    def query_install_repo(self, vm_fqdn):
+        """ query the install repo from cobbler """
+        log.debug("in query_install_repo()")
+        return self._install_repo(self.cobbler.get_system_for_koan(vm_fqdn))
+
+    def query_profile_install_repo(self, profile):
+        """ the install repo of a profile.  much cheaper than query_install_repo,
+            which has cobbler render the whole system """
+        log.debug("in query_profile_install_repo()")
+        return self._install_repo(self.cobbler.get_profile_for_koan(profile))
+
+    def get_systems(self):
+        """ every system cobbler has, in one request """
+        return self.cobbler.get_systems()
+
+    def remove_systems(self, fqdns):
+        """ remove many systems, in one request where cobbler has system.multicall.
+            returns {fqdn: fault} for systems that could not be removed """
+        errors = {}
+        if self.bulk_modes[0] == 'multicall':
+            multicall = xmlrpclib.MultiCall(self.cobbler)
+            for fqdn in fqdns:
+                multicall.remove_system(fqdn, self.token)
+            try:
+                results = multicall()
+                for i in range(0, len(fqdns)):
+                    try:
+                        results[i]
+                    except xmlrpclib.Fault, e:
+                        errors[fqdns[i]] = e
+                return errors
+            except xmlrpclib.Fault, e:
+                if not self._unsupported(e):
+                    raise
+                log.debug("cobbler does not support multicall: %s" % e.faultString)
+                self.bulk_modes = self.bulk_modes[1:]
+        for fqdn in fqdns:
+            try:
+                self.cobbler.remove_system(fqdn, self.token)
+            except xmlrpclib.Fault, e:
+                errors[fqdn] = e
+        return errors
+
+    def get_system(self, fqdn):
+        """ the cobbler record of fqdn, or None if there is none """
+        system = self.cobbler.get_system(fqdn)
+        if not system or system == '~':
+            return None
+        return system
+
+    def modify_system_fields(self, fqdn, fields):
+        """ change some fields of an existing system and save it """
+        handle = self.cobbler.get_system_handle(fqdn, self.token)
+        for field, value in fields:
+            self.cobbler.modify_system(handle, field, value, self.token)
+        self.cobbler.save_system(handle, self.token)
 
     def purge(self, myvm):
         """ remove cobbler profile. this assumes that the cobbler profile matches the FQDN of the VM """
         self.cobbler.remove_system(myvm.fqdn, self.token)
         pass
+
+    def keep_alive(self, max_idle=300):
+        """ cobbler tokens expire when they go unused for a while.  a connection
+            idle for longer than max_idle seconds checks its token and logs in
+            again if it is gone """
+        if time.time() - self.last_used > max_idle:
+            try:
+                self.cobbler.token_check(self.token)
+            except xmlrpclib.Fault:
+                log.info("cobbler token expired, logging in again")
+                self.token = self.cobbler.login(self.username, self.password)
+        self.last_used = time.time()
     
     def __init__(self, cobbler_server, options):
         # make initial cobbler connection
         self.cobbler = self.get_cobbler_server(cobbler_server)
         self.cobbler_server = cobbler_server
+        self.username = options.cblr_username
+        self.password = options.cblr_password
         
         # try to login to the cobbler server
         try:
@@ -600,6 +1756,276 @@ class cobbler:
         except xmlrpclib.Fault, e:
             log.error(e)
             sys.exit(-1)
+        self.last_used = time.time()
+
+class CobblerCache:
+    """ every system in cobbler, fetched with one get_systems rather than a
+        request per VM, and indexed by name, hostname, IP and MAC address.
+        systems mkvm adds or removes are kept up to date as it goes """
+
+    def __init__(self, cblr):
+        self.cblr = cblr
+        self.lock = threading.Lock()
+        self.systems = {}
+        self.hostnames = {}
+        self.ips = {}
+        self.macs = {}
+        self.refresh()
+
+    def refresh(self):
+        """ fetch every system again """
+        self.lock.acquire()
+        try:
+            start = time.time()
+            systems = self.cblr.get_systems()
+            self.systems, self.hostnames, self.ips, self.macs = {}, {}, {}, {}
+            for system in systems:
+                hostnames, ips, macs = [system.get('hostname')], [], []
+                for interface in (system.get('interfaces') or {}).values():
+                    hostnames.append(interface.get('dns_name'))
+                    ips.append(interface.get('ip_address'))
+                    macs.append(interface.get('mac_address'))
+                self._add(system['name'], hostnames, ips, macs)
+            log.debug("fetched %i cobbler systems in %.2fs" % (len(self.systems), time.time() - start))
+        finally:
+            self.lock.release()
+
+    def _add(self, name, hostnames, ips, macs):
+        """ index a system.  call with the lock held """
+        self._remove(name)
+        entry = self.systems[name] = ([h.lower() for h in hostnames if h], [ip for ip in ips if ip], [mac.lower() for mac in macs if mac])
+        for hostname in entry[0]:
+            self.hostnames[hostname] = name
+        for ip in entry[1]:
+            self.ips[ip] = name
+        for mac in entry[2]:
+            self.macs[mac] = name
+
+    def _remove(self, name):
+        """ drop a system from the indexes.  call with the lock held """
+        if name not in self.systems:
+            return
+        for index, keys in zip((self.hostnames, self.ips, self.macs), self.systems.pop(name)):
+            for key in keys:
+                if index.get(key) == name:
+                    del index[key]
+
+    def _nic_values(self, xenvm, field):
+        """ the non-empty <field>-<iface> values of xenvm's nics """
+        return [nic['%s-%s' % (field, iface)] for iface, nic in xenvm.nics.items() if nic.get('%s-%s' % (field, iface))]
+
+    def add(self, xenvm):
+        """ index a system mkvm registered for xenvm """
+        self.lock.acquire()
+        try:
+            self._add(xenvm.fqdn, [xenvm.fqdn] + self._nic_values(xenvm, 'dnsname'),
+                      self._nic_values(xenvm, 'ipaddress'), self._nic_values(xenvm, 'macaddress'))
+        finally:
+            self.lock.release()
+
+    def remove(self, fqdn):
+        self.lock.acquire()
+        try:
+            self._remove(fqdn)
+        finally:
+            self.lock.release()
+
+    def has_system(self, fqdn):
+        return fqdn in self.systems
+
+    def mac_in_use(self, mac):
+        return mac.lower() in self.macs
+
+    def conflicts(self, xenvm):
+        """ why xenvm can not be registered without stepping on another system:
+            one by the same name, or another system with its hostname, an IP
+            address or a MAC address it is going to use """
+        self.lock.acquire()
+        try:
+            conflicts = []
+            if xenvm.fqdn in self.systems:
+                conflicts.append('cobbler already has a system named %s' % xenvm.fqdn)
+            for hostname in set([xenvm.fqdn] + self._nic_values(xenvm, 'dnsname')):
+                owner = self.hostnames.get(hostname.lower())
+                if owner and owner != xenvm.fqdn:
+                    conflicts.append('cobbler system %s has hostname %s' % (owner, hostname))
+            for ip in self._nic_values(xenvm, 'ipaddress'):
+                owner = self.ips.get(ip)
+                if owner and owner != xenvm.fqdn:
+                    conflicts.append('cobbler system %s has IP address %s' % (owner, ip))
+            for mac in self._nic_values(xenvm, 'macaddress'):
+                owner = self.macs.get(mac.lower())
+                if owner and owner != xenvm.fqdn:
+                    conflicts.append('cobbler system %s has MAC address %s' % (owner, mac))
+            return conflicts
+        finally:
+            self.lock.release()
+
+
+class InstallRepoResolver:
+    """ the install repository of each cobbler profile.  it depends on the
+        profile and its distro, never on the system, so it is looked up once
+        per profile and kept for ttl seconds, in memory and in cache_file for
+        the next run.  workers asking for the same profile at once wait for
+        the first one's answer """
+
+    cache_version = 1
+
+    def __init__(self, cache_file=None, ttl=3600):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.profile_locks = {}
+        # profile -> (install repo, when it was looked up)
+        self.repos = {}
+        if cache_file:
+            self._read()
+
+    def _read(self):
+        try:
+            cache_file = open(self.cache_file, 'rb')
+            try:
+                cache = cPickle.load(cache_file)
+            finally:
+                cache_file.close()
+        except Exception, e:
+            log.debug("no usable install repo cache in %s: %s" % (self.cache_file, e))
+            return
+        if cache.get('version') == self.cache_version:
+            self.repos = cache['repos']
+
+    def _save(self):
+        """ write the cache out, replacing the file atomically.  call with the lock held """
+        try:
+            if not os.path.isdir(os.path.dirname(self.cache_file)):
+                os.makedirs(os.path.dirname(self.cache_file), 0700)
+            tmp = '%s.%i' % (self.cache_file, os.getpid())
+            cache_file = os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'wb')
+            try:
+                cPickle.dump({ 'version' : self.cache_version, 'repos' : self.repos }, cache_file, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                cache_file.close()
+            os.rename(tmp, self.cache_file)
+        except (IOError, OSError), e:
+            log.warn("unable to save install repo cache %s: %s" % (self.cache_file, e))
+
+    def resolve(self, cblr, profile):
+        """ the install repo of profile, asking cobbler through cblr if it is not
+            known or is older than ttl seconds """
+        self.lock.acquire()
+        try:
+            profile_lock = self.profile_locks.setdefault(profile, threading.Lock())
+        finally:
+            self.lock.release()
+
+        profile_lock.acquire()
+        try:
+            entry = self.repos.get(profile)
+            if entry and time.time() - entry[1] < self.ttl:
+                return entry[0]
+            install_repo = cblr.query_profile_install_repo(profile)
+            log.debug("install repo of profile %s is %s" % (profile, install_repo))
+            # a profile cobbler could not answer for is asked again next time,
+            # and with no ttl there is nothing worth keeping
+            if install_repo is None or self.ttl <= 0:
+                return install_repo
+            self.lock.acquire()
+            try:
+                self.repos[profile] = (install_repo, time.time())
+                if self.cache_file:
+                    self._save()
+            finally:
+                self.lock.release()
+            return install_repo
+        finally:
+            profile_lock.release()
+
+
+class CobblerRegistrar(threading.Thread):
+    """ register (and remove) systems on behalf of all the workers.  whatever
+        has queued up (waiting up to linger seconds for more) goes to cobbler
+        as one batch.  systems is the CobblerCache to keep up to date, if any """
+
+    def __init__(self, cblr, linger=0.0, systems=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.cblr = cblr
+        self.linger = linger
+        self.systems = systems
+        self.queue = Queue.Queue()
+
+    def _queue(self, action, xenvm):
+        """ queue xenvm for the next batch and block until that batch is done """
+        done = threading.Event()
+        outcome = {}
+        self.queue.put((action, xenvm, done, outcome))
+        done.wait()
+        if 'error' in outcome:
+            raise outcome['error']
+
+    def register(self, xenvm):
+        self._queue('register', xenvm)
+
+    def purge(self, xenvm):
+        """ remove xenvm's system, unless cobbler is known not to have one """
+        if self.systems and not self.systems.has_system(xenvm.fqdn):
+            log.debug("cobbler has no system named %s" % xenvm.fqdn)
+            return
+        self._queue('remove', xenvm)
+
+    def stop(self):
+        """ finish the batch in progress and exit """
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.linger
+            while batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get(True, max(0.0, deadline - time.time())))
+                except Queue.Empty:
+                    break
+
+            stopping = batch[-1] is None
+            batch = [item for item in batch if item is not None]
+            if batch:
+                self._register(batch)
+            if stopping:
+                return
+
+    def _register(self, batch):
+        """ send one batch and wake up everybody waiting on it """
+        errors = {}
+        for action, send in (('register', self.cblr.register_systems), ('remove', self._remove_systems)):
+            xenvms = [xenvm for item_action, xenvm, done, outcome in batch if item_action == action]
+            if not xenvms:
+                continue
+            try:
+                self.cblr.keep_alive()
+                errors[action] = send(xenvms)
+            except Exception, e:
+                log.debug(traceback.format_exc())
+                errors[action] = dict([(xenvm.fqdn, e) for xenvm in xenvms])
+            if self.systems:
+                for xenvm in xenvms:
+                    if xenvm.fqdn in errors[action]:
+                        continue
+                    if action == 'register':
+                        self.systems.add(xenvm)
+                    else:
+                        self.systems.remove(xenvm.fqdn)
+
+        for action, xenvm, done, outcome in batch:
+            if xenvm.fqdn in errors[action]:
+                outcome['error'] = errors[action][xenvm.fqdn]
+            done.set()
+
+    def _remove_systems(self, xenvms):
+        log.info("removing %i systems from cobbler" % len(xenvms))
+        return self.cblr.remove_systems([xenvm.fqdn for xenvm in xenvms])
+
 
 def purge_vm(myvm, options, cobbler, xensession):
     """ this will shutdown and delete any existing VMs with the same xencenter name """
@@ -619,61 +2045,968 @@ def purge_vm(myvm, options, cobbler, xensession):
         print "##### YOU HAVE 5 SECONDS TO INTERUPT THIS WITH CTRL+C #####"
         time.sleep(5)
         
-    for existing_vm in myvm.is_existing_vm():
-        vbd, vif, existing_VDIs = [], [], []
-        existing_VBDs = xencache._get_all_vm_records()[existing_vm]['VBDs']
-        existing_VIFs = xencache._get_all_vm_records()[existing_vm]['VIFs']
+    existing_vms = myvm.is_existing_vm()
+    if not existing_vms:
+        return
+
+    teardown = Teardown(myvm.xenapi, xensession, options.max_tasks)
+    for existing_vm in existing_vms:
+        teardown.add_vm(existing_vm)
+    destroy_span = instrument.span('destroy', vm=myvm.name)
+    try:
+        teardown_errors = teardown.run()
+    finally:
+        destroy_span.end()
+    for existing_vm, errors in teardown_errors.items():
+        for label, error in sorted(errors.items()):
+            log.debug("%s failed (%s). Assuming it is already done..." % (label, ' '.join(error)))
+    for existing_vm in existing_vms:
+        myvm.xencache.remove_vm(existing_vm)
+
+    if options.add_to_cobbler:
+        log.info("removing cobbler profile for %s" % myvm.fqdn)
+        remove_span = instrument.span('cobbler remove', vm=myvm.name)
+        try:
+            cobbler.purge(myvm)
+        finally:
+            remove_span.end()
+        log.info("VM (%s) was destroyed and its system profile (%s) was removed from cobbler" % (myvm.name, myvm.fqdn))
+    else:
+        log.info("VM (%s) was destroyed" % myvm.name)
+
+
+def xen_login(xenserver, username, password, protocol='xmlrpc', use_gzip=False):
+    """ open a new XenAPI connection and log in to it """
+    log.debug("in xen_login()")
+
+    xenapi = xenapi_proxy(xenserver, protocol, use_gzip, instrument.recorder)
+    xensession = xenapi.session.login_with_password(username, password)['Value']
+    return xenapi, xensession
 
-        log.info('sending power off command to VM %s' % existing_vm) 
+
+class PipelineStage(threading.Thread):
+    """ run one stage of a VM's provisioning on its own thread.  wait() hands
+        back the stage's return value, or re-raises whatever it raised """
+
+    def __init__(self, func, *args):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+
+    def run(self):
         try:
-            log.debug("powering off %s" % existing_vm)
-            xenapi.VM.hard_shutdown(xensession, existing_vm)
+            self.result = self.func(*self.args)
         except:
-            log.debug("power off command failed. Assuming VM is already shutdown...")
+            self.error = sys.exc_info()
+
+    def wait(self):
+        self.join()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+
+class BootScheduler(threading.Thread):
+    """ start autostarted VMs no faster than cobbler and the install repo can
+        take them, and follow each one until it is up.
+
+        starts are paced by a token bucket (rate boots a minute, 0 for no
+        limit) and by a cap on VMs that are installing, i.e. started and not
+        up yet.  a VM is up once its guest metrics report a network address.
+        one that powers itself off (a kickstart ending in poweroff) is done
+        too.  VMs are watched with event.from on just their own VM and
+        VM_guest_metrics objects, or polled where event.from is not available.
+
+        each VM's job gets its result when the VM is up, halted, timed out or
+        failed to start, with the time it took to get there.  without a
+        timeout, a VM that is not up after hold seconds (one without guest
+        tools never will be) frees its slot and counts as started.  with
+        neither, VMs count as started as soon as they are. """
+
+    poll_interval = 10
+    start_attempts = 3
+
+    def __init__(self, connect, max_installing=10, rate=0, timeout=0, hold=1800):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.connect = connect
+        self.max_installing = max_installing
+        self.rate = rate
+        self.timeout = timeout
+        # how long a VM is followed before it is given up on
+        self.limit = timeout or hold
+        self.condition = threading.Condition()
+        # [job, vm, job start, attempts, not before], in the order they came in
+        self.queued = []
+        # vm -> [job, job start, boot time]
+        self.installing = {}
+        # vm -> its VM_guest_metrics, once it has one
+        self.metrics = {}
+        self.tokens = 1.0
+        self.last_fill = time.time()
+        self.events = True
+        self.token = ''
+        self.xenapi = None
+        self.xensession = None
+
+    def submit(self, job, vm, job_start):
+        """ boot vm for job as soon as the pacing allows """
+        self.condition.acquire()
+        try:
+            self.queued.append([job, vm, job_start, 0, 0])
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def drain(self):
+        """ wait until every VM submitted so far has a result """
+        self.condition.acquire()
+        try:
+            while self.queued or self.installing:
+                # a timeout, so ctrl+c still reaches the main thread
+                self.condition.wait(1)
+        finally:
+            self.condition.release()
+
+    def _take_token(self):
+        """ whether the bucket allows another boot now """
+        if not self.rate:
+            return True
+        now = time.time()
+        self.tokens = min(1.0, self.tokens + (now - self.last_fill) * self.rate / 60.0)
+        self.last_fill = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+    def _finish(self, job, job_start, status, detail):
+        job.results.put((job, status, time.time() - job_start, detail))
+
+    def _start_ready(self):
+        """ start whatever the cap and the bucket allow """
+        self.condition.acquire()
+        try:
+            now = time.time()
+            ready = [entry for entry in self.queued if entry[4] <= now]
+        finally:
+            self.condition.release()
+        for entry in ready:
+            if self.max_installing and len(self.installing) >= self.max_installing:
+                return
+            if not self._take_token():
+                return
+            job, vm, job_start, attempts, not_before = entry
+            log.info("sending start command to VM %s" % vm)
+            result = self.xenapi.VM.start(self.xensession, vm, False, True)
+            self.condition.acquire()
+            try:
+                if result['Status'] == 'Success':
+                    self.queued.remove(entry)
+                    self.installing[vm] = [job, job_start, time.time()]
+                    job.finish()
+                elif attempts + 1 >= self.start_attempts:
+                    self.queued.remove(entry)
+                    log.warn("VM %s did not autoboot.  Please manually boot up the VM" % job.vmname)
+                    self._finish(job, job_start, 'failed', 'did not start: %s' % ' '.join(result['ErrorDescription']))
+                else:
+                    # back off instead of hammering a host that just said no
+                    entry[3] += 1
+                    entry[4] = time.time() + 5 * 2 ** attempts
+                    log.debug("attempt %i to boot %s failed: %s" % (entry[3], job.vmname, result['ErrorDescription']))
+            finally:
+                self.condition.release()
+
+    def _check(self, vms):
+        """ see which of vms are up (or down) and report on them """
+        batch = XenBatch(self.xenapi, self.xensession)
+        for vm in vms:
+            batch.add('power %s' % vm, 'VM.get_power_state', vm)
+            batch.add('metrics %s' % vm, 'VM.get_guest_metrics', vm)
+        results = batch.send(ignore_errors=True)
+        for vm in vms:
+            metrics = results.get('metrics %s' % vm, 'OpaqueRef:NULL')
+            if metrics != 'OpaqueRef:NULL':
+                self.metrics[vm] = metrics
+                batch.add(vm, 'VM_guest_metrics.get_networks', metrics)
+        results = batch.send(ignore_errors=True)
+
+        now = time.time()
+        self.condition.acquire()
+        try:
+            for vm in vms:
+                job, job_start, booted = self.installing[vm]
+                status = None
+                if results.get(vm):
+                    status, detail = 'ready', 'up %.0fs after boot' % (now - booted)
+                elif results.get('power %s' % vm) == 'Halted':
+                    status, detail = 'halted', 'powered off %.0fs after boot' % (now - booted)
+                elif now - booted > self.limit and self.timeout:
+                    status, detail = 'timed out', 'not up %.0fs after boot' % (now - booted)
+                elif now - booted > self.limit:
+                    status, detail = 'started', 'no network address %.0fs after boot' % (now - booted)
+                if status:
+                    log.info("VM %s is %s, %s" % (job.vmname, status, detail))
+                    instrument.add_span('boot', booted, now, 'boot %s' % job.vmname, vm=job.vmname, status=status)
+                    del self.installing[vm]
+                    self.metrics.pop(vm, None)
+                    self._finish(job, job_start, status, detail)
+                    self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def _watch(self, wait):
+        """ wait up to wait seconds for the installing VMs to change, and check the ones that did """
+        vms = self.installing.keys()
+        if not self.limit:
+            # nobody wants to know when they are up
+            self.condition.acquire()
+            try:
+                for vm in vms:
+                    job, job_start, booted = self.installing.pop(vm)
+                    self._finish(job, job_start, 'started', '')
+                self.condition.notifyAll()
+            finally:
+                self.condition.release()
+            return
+
+        if self.events:
+            # only the objects being watched, not every VM in the pool
+            watched = dict([(self.metrics[vm], vm) for vm in vms if vm in self.metrics])
+            classes = ['vm/%s' % vm for vm in vms] + ['vm_guest_metrics/%s' % metrics for metrics in watched]
+            events = getattr(self.xenapi.event, 'from')(self.xensession, classes, self.token, float(wait))
+            if events['Status'] == 'Success':
+                self.token = events['Value']['token']
+                changed = set([watched.get(event['ref'], event['ref']) for event in events['Value']['events']])
+                self._check([vm for vm in vms if vm in changed or time.time() - self.installing[vm][2] > self.limit])
+                return
+            log.info("event.from is not available (%s), polling booting VMs every %is" % (' '.join(events['ErrorDescription']), self.poll_interval))
+            self.events = False
+
+        time.sleep(min(wait, self.poll_interval))
+        self._check(vms)
+
+    def run(self):
+        while True:
+            try:
+                if self.xensession is None:
+                    self.xenapi, self.xensession = self.connect()[:2]
+                    self.token = ''
+                self._start_ready()
+
+                self.condition.acquire()
+                try:
+                    if not self.installing:
+                        # nothing to watch, so wait for something to start
+                        self.condition.wait(self.queued and 1 or None)
+                        continue
+                finally:
+                    self.condition.release()
+                # come back in time for the next token, or a backed-off retry
+                self._watch(self.queued and 1 or self.poll_interval)
+            except Exception, e:
+                log.error("boot scheduler lost its XenAPI session: %s" % e)
+                log.debug(traceback.format_exc())
+                self.xensession = None
+                time.sleep(self.poll_interval)
+
+
+class StepJournal:
+    """ the steps each VM got through on its way to being created, so a run
+        that failed half way can be picked up where it left off instead of
+        cloning, registering and resizing all over again.
+
+        there is a file per env file in directory, named after the sha1 of the
+        env file's contents, so editing the env file starts afresh.  each line
+        is "<vm name>\t<step>\t<value>", appended and synced as the step
+        finishes.  a VM's steps are dropped once it is created and started, and
+        the file goes with the last of them """
+
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+        self.lock = threading.Lock()
+        # digest -> vm name -> step -> value
+        self.journals = {}
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def _load(self, digest):
+        """ the steps in digest's file.  call with the lock held """
+        if digest in self.journals:
+            return self.journals[digest]
+        steps = {}
+        try:
+            for line in open(self._path(digest)):
+                fields = line.rstrip('\n').split('\t', 2)
+                if len(fields) != 3:
+                    continue
+                vmname, step, value = fields
+                if step == 'done':
+                    steps.pop(vmname, None)
+                else:
+                    steps.setdefault(vmname, {})[step] = value
+        except IOError:
             pass
+        self.journals[digest] = steps
+        return steps
+
+    def _append(self, digest, vmname, step, value):
+        """ write a line to digest's file.  call with the lock held """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0700)
+        journal = open(self._path(digest), 'a')
+        try:
+            journal.write('%s\t%s\t%s\n' % (vmname, step, value))
+            journal.flush()
+            os.fsync(journal.fileno())
+        finally:
+            journal.close()
+
+    def completed(self, digest, vmname):
+        """ the steps vmname got through in an earlier run, as { step : value } """
+        self.lock.acquire()
+        try:
+            return dict(self._load(digest).get(vmname, {}))
+        finally:
+            self.lock.release()
 
-        for uuid in existing_VBDs:
-            existing_VDIs.append(xenapi.VBD.get_record(xensession, uuid)['Value']['VDI'])
-            log.info('sending destroy command for VBD %s' % uuid)
+    def record(self, digest, vmname, step, value=''):
+        self.lock.acquire()
+        try:
+            self._load(digest).setdefault(vmname, {})[step] = value
             try:
-                log.debug("destroying VBD %s" % uuid)
-                xenapi.VBD.destroy(xensession, uuid)
-            except:
-                log.debug("VBD destroy command failed. Assuming VBD is already destroyed...")
-                pass
-
-        for uuid in existing_VIFs:
-            log.info('sending destroy command for VIF %s' % uuid)
+                self._append(digest, vmname, step, value)
+            except (IOError, OSError), e:
+                log.warn("unable to journal step %s of %s: %s" % (step, vmname, e))
+        finally:
+            self.lock.release()
+
+    def finish(self, digest, vmname):
+        """ forget vmname's steps, and the file once no VM has any left """
+        self.lock.acquire()
+        try:
+            steps = self._load(digest)
+            if vmname not in steps:
+                return
+            del steps[vmname]
             try:
-                log.debug("destroying VIF %s" % uuid)
-                xenapi.VIF.destroy(xensession, uuid)
-            except:
-                log.debug("VIF destroy command failed. Assuming VIF is already destroyed...")
-                pass
-
-        for uuid in existing_VDIs:
-            log.info('sending destroy command for VDI %s' % uuid)
+                if steps:
+                    self._append(digest, vmname, 'done', '')
+                else:
+                    os.unlink(self._path(digest))
+            except (IOError, OSError), e:
+                log.warn("unable to journal that %s is done: %s" % (vmname, e))
+        finally:
+            self.lock.release()
+
+
+class ProvisionJob:
+    """ one VM to create or destroy, along with the env file and options it
+        came with.  when it is done, (job, status, seconds, detail) is put on
+        results, which only needs a put() method.  the steps it gets through
+        go into journal, a StepJournal, if there is one """
+
+    def __init__(self, vmname, cfg, options, results, job_id=None, journal=None):
+        self.vmname = vmname
+        self.cfg = cfg
+        self.options = options
+        self.results = results
+        self.job_id = job_id
+        self.journal = journal
+        self.placement = None
+
+    def __str__(self):
+        return self.vmname
+
+    def completed(self):
+        """ the steps an earlier run got through for this VM """
+        if not self.journal:
+            return {}
+        return self.journal.completed(self.cfg.digest, self.vmname)
+
+    def record(self, step, value=''):
+        if self.journal:
+            self.journal.record(self.cfg.digest, self.vmname, step, value)
+
+    def finish(self):
+        if self.journal:
+            self.journal.finish(self.cfg.digest, self.vmname)
+
+
+class ProvisionWorker(threading.Thread):
+    """ provision VMs pulled off a shared queue of (priority, sequence, job).
+        xmlrpclib connections can not be shared between threads, so each worker
+        opens its own XenAPI session (and cobbler connection) through the
+        connect() callable it is given.
+
+        a worker of a batch run stops when the queue is empty.  a daemon's
+        workers (wait_for_jobs) wait for more, and check that their logins are
+        still good before picking up a job after having been idle """
+
+    # seconds a daemon worker may sit idle before checking its sessions
+    max_idle = 300
+
+    def __init__(self, jobs, tmpl, xencache, macs, registrar, cobbler_server, connect, wait_for_jobs=False, warm_pool=None, boots=None, install_repos=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.jobs = jobs
+        self.options = None
+        self.cfg = None
+        self.placement = None
+        self.tmpl = tmpl
+        self.xencache = xencache
+        self.macs = macs
+        self.registrar = registrar
+        self.cobbler_server = cobbler_server
+        self.connect = connect
+        self.wait_for_jobs = wait_for_jobs
+        self.warm_pool = warm_pool
+        self.boots = boots
+        self.install_repos = install_repos
+        self.job = None
+        self.job_start = None
+        self.xenapi = None
+        self.xensession = None
+        self.cblr = None
+        self.last_job = time.time()
+
+    def provision(self, vmname):
+        """ configure and create (or destroy) a single VM.  returns a short status
+            for the run summary and a few words on why, if it was skipped """
+        log.debug("setting up %s" % vmname)
+        options = self.options
+        myvm = XenVM(vmname, self.xencache, self.xenapi, self.xensession)
+
+        # cache some xen information so we don't have to query xenserver multiple times for the same data
+        myvm.sr_aggr = self.xencache._get_shared_storage
+        myvm.vm_template = self.xencache._get_xen_templates
+
+        # apply configurations from either the template or user supplied values
+        configure_span = instrument.span('configure', vm=vmname)
+        try:
+            myvm.configure(self.cfg, self.tmpl, self.cobbler_server, options.cblr_username)
+        finally:
+            configure_span.end()
+        myvm.placement = self.placement
+
+        log.debug("Created new XenVM object: %s" % str(myvm))
+
+        # if invoked to delete VMs, run through the input file and delete all matches
+        if options.destroy:
+            purge_vm(myvm, options, self.registrar, self.xensession)
+            self.job.finish()
+            return 'destroyed', ''
+
+        # pick up where an earlier run of this env file failed
+        myvm.job = self.job
+        myvm.steps = self.job.completed()
+        resuming = 'cloned' in myvm.steps
+        if resuming and self.xenapi.VM.get_power_state(self.xensession, myvm.steps['cloned'])['Status'] != 'Success':
+            log.info("the VM an earlier run cloned for %s is gone, starting over on the xen side" % myvm.name)
+            # the cobbler system and its MAC address are still there, so only the xen steps go
+            kept = dict([(step, value) for step, value in myvm.steps.items() if step in ('cobbler-registered', 'mac-allocated')])
+            self.job.finish()
+            for step, value in kept.items():
+                self.job.record(step, value)
+            myvm.steps = kept
+            resuming = False
+        elif myvm.steps:
+            log.info("resuming %s after %s" % (myvm.name, ', '.join(sorted(myvm.steps))))
+        # the warm claim below journals steps of its own, so remember this now
+        fresh = not myvm.steps
+
+        # warn the user before creating an identical VM.  the half-built one
+        # being resumed does not count.
+        if myvm.is_existing_vm() and resuming:
+            myvm.existing_vm = [vm for vm in myvm.existing_vm if vm != myvm.steps['cloned']]
+        # bring an existing VM in line with the env file rather than skip or rebuild it
+        if options.reconcile and myvm.existing_vm:
+            return self._reconcile(myvm)
+
+        if myvm.existing_vm and not options.ignore:
+            log.error('%s already exists. Aborting creation of %s. To ignore this and create it anyway, use -i. To REPLACE (destroy the existing and build a new one) this VM, use -r.' % \
+                (myvm.name, myvm.name))
+            if not self.wait_for_jobs:
+                time.sleep(2)
+            return 'skipped', 'a VM named %s already exists' % myvm.name
+
+        # the same goes for a VM of another name that already claims this FQDN
+        fqdn_vm = self.xencache.find_vm_by_fqdn(myvm.fqdn)
+        if fqdn_vm and fqdn_vm not in myvm.existing_vm and fqdn_vm != myvm.steps.get('cloned') and not options.ignore:
+            log.error('%s is already in use by VM %s. Aborting creation of %s. To ignore this and create it anyway, use -i.' % \
+                (myvm.fqdn, self.xencache._get_all_vm_records()[fqdn_vm]['name_label'], myvm.name))
+            return 'skipped', '%s is already in use by VM %s' % (myvm.fqdn, self.xencache._get_all_vm_records()[fqdn_vm]['name_label'])
+
+        # and before overwriting a cobbler system, or registering one that
+        # shares a hostname or address with another
+        systems = self.registrar and self.registrar.systems
+        if systems and options.add_to_cobbler and not options.ignore and 'cobbler-registered' not in myvm.steps:
+            conflicts = systems.conflicts(myvm)
+            if conflicts:
+                log.error('%s. Aborting creation of %s. To ignore this and register it anyway, use -i.' % ('; '.join(conflicts), myvm.name))
+                return 'skipped', '; '.join(conflicts)
+
+        # a warm pool VM has its clone, disk and VIF already, so it needs no room of its own
+        warm = None
+        if 'warm' in myvm.steps:
+            warm = WarmVM(*myvm.steps['warm'].split(' '))
+            warm.disk_size = int(warm.disk_size)
+        elif self.warm_pool and not resuming:
+            claim_span = instrument.span('warm claim', vm=vmname)
             try:
-                log.debug("destroying VDI %s" % uuid)
-                xenapi.VDI.destroy(xensession, uuid)
-            except:
-                log.debug("VDI destroy command failed.  Assuming VDI is already destroyed...")
-                pass
+                warm = self.warm_pool.claim(myvm, self.xenapi, self.xensession)
+            finally:
+                claim_span.end()
+            if warm:
+                myvm._record('warm', '%s %s %i %s %s' % (warm.vm, warm.vdi, warm.disk_size, warm.vif, warm.mac))
+                myvm._record('cloned', warm.vm)
+
+        if not warm and not resuming and self.placement and self.placement.error:
+            log.error('Not creating %s: %s' % (myvm.name, self.placement.error))
+            return 'skipped', self.placement.error
+
+        if options.replace and fresh:
+            purge_vm(myvm, options, self.registrar, self.xensession)
+
+        myvm.set_ks_url(self.cobbler_server)
+
+        # the MAC address is picked up front, so it goes into the VIF and into
+        # the first (and only) cobbler save for this system.
+        if warm:
+            myvm.mac_addr = warm.mac
+        elif 'mac-allocated' in myvm.steps:
+            myvm.mac_addr = myvm.steps['mac-allocated']
+        else:
+            myvm.mac_addr = self.macs.allocate()
+            myvm._record('mac-allocated', myvm.mac_addr)
+        myvm.nics['eth0']['macaddress-eth0'] = myvm.mac_addr
+
+        # cobbler registration and the xen clone have nothing to do with each
+        # other, so they run side by side and meet again before the boot.
+        cobbler_stage = None
+        if options.add_to_cobbler:
+            cobbler_stage = PipelineStage(self._cobbler_stage, myvm)
+            cobbler_stage.start()
+
+        try:
+            self._xen_stage(myvm, warm)
+        finally:
+            if cobbler_stage:
+                cobbler_stage.join()
+
+        install_repo = cobbler_stage and cobbler_stage.wait()
+        if install_repo:
+            # add the install repository location for kickstart
+            log.debug("adding install repo to VM %s" % myvm.vm_uuid)
+            repo_span = instrument.span('set install repo', vm=vmname)
+            self.xenapi.VM.add_to_other_config(self.xensession, myvm.vm_uuid, 'install-repository', install_repo)
+            repo_span.end()
+
+        if options.autostart:
+            # the boot scheduler reports on this job once the VM is up
+            log.info("VM %s successfully created, queued to boot." % myvm.name)
+            self.boots.submit(self.job, myvm.vm_uuid, self.job_start)
+            return 'booting', ''
+
+        self.job.finish()
+        log.info("VM %s successfully created." % myvm.name)
+        return 'created', ''
+
+    def _reconcile(self, myvm):
+        """ change only what differs between myvm's existing VM and its env file section """
+        if len(myvm.existing_vm) > 1:
+            return 'skipped', '%i VMs are named %s, reconcile needs exactly one' % (len(myvm.existing_vm), myvm.name)
+        if self.cblr:
+            self.cblr.keep_alive()
+        reconcile_span = instrument.span('reconcile', vm=myvm.name)
+        try:
+            changed, remaining = myvm.reconcile(myvm.existing_vm[0], self.cblr)
+        finally:
+            reconcile_span.end()
+        if changed:
+            log.info("reconciled %s: %s" % (myvm.name, ', '.join(changed)))
+            self.xencache.add_vm(myvm.vm_uuid, self.xenapi.VM.get_record(self.xensession, myvm.vm_uuid)['Value'])
+        if remaining:
+            log.warn("%s still differs from %s: %s" % (myvm.name, self.cfg.filename, ', '.join(remaining)))
+            return 'drifted', '; '.join(changed + remaining)
+        if changed:
+            return 'reconciled', ', '.join(changed)
+        return 'unchanged', ''
+
+    def _cobbler_stage(self, myvm):
+        """ register the system in cobbler and look up its install repository,
+            which a VM built from a golden image has no use for """
+        if 'cobbler-registered' not in myvm.steps:
+            log.info("Adding %s to cobbler" % myvm.name)
+            register_span = instrument.span('cobbler register', vm=myvm.name)
+            try:
+                self.registrar.register(myvm)
+            finally:
+                register_span.end()
+            myvm._record('cobbler-registered')
+        if myvm.image:
+            return None
+        repo_span = instrument.span('install repo', vm=myvm.name)
+        try:
+            if self.install_repos:
+                return self.install_repos.resolve(self.cblr, myvm.cobbler_profile)
+            return self.cblr.query_install_repo(myvm.fqdn)
+        finally:
+            repo_span.end()
+
+    def _xen_stage(self, myvm, warm=None):
+        """ clone the VM (or finish a claimed warm one) and record who made it.
+            booting is left until cobbler knows the MAC address. """
+        if warm:
+            myvm.create_from_warm(warm)
+        else:
+            myvm.create()
 
-        log.info('sending destroy command for VM %s' % existing_vm)
         try:
-            log.debug("destroying VM %s" % existing_vm)
-            xenapi.VM.destroy(xensession, existing_vm)
+            activity_log = open(default_activity_log_file, 'a')
+            activity_log.write('%s: %s created VM %s\n' % (strftime("%Y-%m-%d %H:%M:%S"), self.options.cblr_username, myvm.name))
+            activity_log.close()
         except:
-            log.debug("VM destroy command failed.  Assuming VM is already destroyed...")
             pass
 
-        if options.add_to_cobbler:
-            log.info("removing cobbler profile for %s" % myvm.fqdn)
-            cobbler.purge(myvm)
-            log.info("VM (%s) was destroyed and its system profile (%s) was removed from cobbler" % (myvm.name, myvm.fqdn))
-        else:
-            log.info("VM (%s) was destroyed" % myvm.name)
+        self.xencache.add_vm(myvm.vm_uuid, self.xenapi.VM.get_record(self.xensession, myvm.vm_uuid)['Value'])
+
+    def _keep_alive(self):
+        """ log in again if the XenAPI session or cobbler token went stale while idle """
+        if time.time() - self.last_job < self.max_idle:
+            return
+        if self.xenapi.session.get_this_host(self.xensession, self.xensession)['Status'] != 'Success':
+            log.info("%s lost its XenAPI session, logging in again" % self.getName())
+            self.xenapi, self.xensession, self.cblr = self.connect()
+        elif self.cblr:
+            self.cblr.keep_alive()
+
+    def run_jobs(self):
+        """ work the queue until it is empty (or forever, with wait_for_jobs),
+            reporting one result per job (or leaving that to the boot scheduler) """
+        while True:
+            try:
+                priority, sequence, job = self.jobs.get(self.wait_for_jobs)
+            except Queue.Empty:
+                return
+
+            start = self.job_start = time.time()
+            self.job = job
+            self.options, self.cfg, self.placement = job.options, job.cfg, job.placement
+            try:
+                if self.wait_for_jobs:
+                    self._keep_alive()
+                status, detail = self.provision(job.vmname)
+            except Exception, e:
+                log.error("provisioning %s failed: %s" % (job.vmname, e))
+                log.debug(traceback.format_exc())
+                status, detail = 'failed', str(e)
+            instrument.add_span('provision', start, time.time(), vm=job.vmname, status=status)
+            self.last_job = time.time()
+            if status != 'booting':
+                job.results.put((job, status, time.time() - start, detail))
+
+    def run(self):
+        try:
+            self.xenapi, self.xensession, self.cblr = self.connect()
+        except (Exception, SystemExit), e:
+            log.error("%s was unable to log in: %s" % (self.getName(), e))
+            return
+
+        try:
+            self.run_jobs()
+        finally:
+            self.xenapi.session.logout(self.xensession)
+
+
+class JobBoard:
+    """ the results of a daemon's jobs, kept until the client that submitted
+        them collects them """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.finished = {}
+
+    def put(self, item):
+        job, status, seconds, detail = item
+        self.condition.acquire()
+        try:
+            self.finished[job.job_id] = (job.vmname, status, seconds, detail, time.time())
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def collect(self, job_ids, timeout):
+        """ wait up to timeout seconds for all of job_ids to finish, then hand
+            back [job_id, vmname, status, seconds, detail] for (and forget)
+            those that did """
+        deadline = time.time() + timeout
+        self.condition.acquire()
+        try:
+            while True:
+                done = [job_id for job_id in job_ids if job_id in self.finished]
+                remaining = deadline - time.time()
+                if len(done) == len(job_ids) or remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return [[job_id] + list(self.finished.pop(job_id)[:4]) for job_id in done]
+        finally:
+            self.condition.release()
+
+    def expire(self, max_age=3600):
+        """ drop results whose client never came back for them """
+        self.condition.acquire()
+        try:
+            for job_id, result in self.finished.items():
+                if time.time() - result[4] > max_age:
+                    del self.finished[job_id]
+        finally:
+            self.condition.release()
+
+
+class ProvisionDaemon:
+    """ a long-running mkvm.  the XenAPI and cobbler logins, the XenCache and
+        the workers stay up between jobs, which clients submit over a unix
+        socket.  jobs run highest priority first, and in the order they were
+        submitted within a priority """
+
+    # the options a client may set for its jobs.  everything else comes from the daemon's command line
+    job_options = ['destroy', 'replace', 'ignore', 'reconcile', 'autostart', 'add_to_cobbler', 'cblr_username']
+
+    def __init__(self, options, xencache, planner, tmpl, xen_connect, refresh_interval=10, journal=None, cobbler_cache=None):
+        self.options = options
+        self.journal = journal
+        self.cobbler_cache = cobbler_cache
+        self.xencache = xencache
+        self.planner = planner
+        self.tmpl = tmpl
+        self.xen_connect = xen_connect
+        self.refresh_interval = refresh_interval
+        self.jobs = Queue.PriorityQueue()
+        self.board = JobBoard()
+        self.lock = threading.Lock()
+        self.last_job_id = 0
+        self.started = time.time()
+
+    def submit(self, env_name, env_contents, job_options, priority=0):
+        """ queue every VM of an env file.  returns [job_id, vmname] for each, in file order """
+        cfg = ConfigFile(env_name, env_contents)
+        options = optparse.Values(dict(vars(self.options)))
+        for key in self.job_options:
+            if key in job_options:
+                setattr(options, key, job_options[key])
+        if options.add_to_cobbler and not self.options.add_to_cobbler:
+            raise ValueError("this mkvm daemon was started without cobbler (-c), submit with -c as well")
+        if options.replace:
+            options.ignore = True
+        options.skip_countdown = True
+
+        storage_types = []
+        for section in cfg.configparser.sections():
+            if cfg.configparser.has_option(section, 'storage'):
+                storage_types.append(cfg.configparser.get(section, 'storage'))
+        self.xencache.add_storage_types(storage_types)
+        # the VM and FQDN checks should see the pool as it is now, not as of the last periodic refresh
+        self.xencache.refresh(save=False)
+        if self.cobbler_cache and options.add_to_cobbler:
+            self.cobbler_cache.refresh()
+        self.board.expire()
+
+        self.lock.acquire()
+        try:
+            jobs = []
+            for vmname in cfg.configparser.sections():
+                self.last_job_id += 1
+                jobs.append(ProvisionJob(vmname, cfg, options, self, self.last_job_id, self.journal))
+        finally:
+            self.lock.release()
+        self.planner.plan_jobs(jobs, self.tmpl)
+
+        submitted = []
+        for job in jobs:
+            self.jobs.put((-priority, job.job_id, job))
+            submitted.append([job.job_id, job.vmname])
+        log.info("queued %s for %s at priority %i" % (', '.join([vmname for job_id, vmname in submitted]), options.cblr_username, priority))
+        return submitted
+
+    def put(self, item):
+        """ a worker finished a job """
+        self.planner.release(item[0])
+        self.board.put(item)
+
+    def wait(self, job_ids, timeout=30):
+        """ results of the given jobs that are done, waiting up to timeout seconds for all of them """
+        return self.board.collect(job_ids, min(timeout, 60))
+
+    def status(self):
+        return { 'queued' : self.jobs.qsize(),
+                 'uptime' : time.time() - self.started,
+                 'cache_timings' : self.xencache.timings,
+               }
+
+    def _refresh_loop(self):
+        """ keep the XenCache (and with it the daemon's own session) current """
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.xencache.refresh(save=False)
+            except Exception, e:
+                log.warn("refreshing the XenCache failed (%s), logging in again" % e)
+                try:
+                    self.xencache.lock.acquire()
+                    try:
+                        self.xencache.xenapi, self.xencache.xensession = self.xen_connect()
+                    finally:
+                        self.xencache.lock.release()
+                except Exception, e:
+                    log.error("unable to log in to XenServer: %s" % e)
+
+    def serve(self, socket_path):
+        """ answer clients on socket_path until interrupted """
+        refresher = threading.Thread(target=self._refresh_loop)
+        refresher.setDaemon(True)
+        refresher.start()
+
+        server = UnixXMLRPCServer(socket_path)
+        server.register_function(self.submit, 'submit')
+        server.register_function(self.wait, 'wait')
+        server.register_function(self.status, 'status')
+        log.info("mkvm daemon listening on %s" % socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(socket_path)
+            self.xencache.save()
+
+
+class UnixXMLRPCRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+    # TCP_NODELAY can not be set on a unix socket
+    disable_nagle_algorithm = False
+
+    def address_string(self):
+        # unix socket clients have no address
+        return 'local'
+
+
+class UnixXMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer.SimpleXMLRPCServer):
+    """ XML-RPC on a unix socket that only the daemon's own user can connect to """
+
+    address_family = socket.AF_UNIX
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(self, socket_path, UnixXMLRPCRequestHandler, logRequests=False, allow_none=True)
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            # left behind by a daemon that did not shut down cleanly
+            os.unlink(self.server_address)
+        old_umask = os.umask(0077)
+        try:
+            SimpleXMLRPCServer.SimpleXMLRPCServer.server_bind(self)
+        finally:
+            os.umask(old_umask)
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, socket_path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class UnixSocketTransport(xmlrpclib.Transport):
+    def __init__(self, socket_path):
+        xmlrpclib.Transport.__init__(self)
+        self.socket_path = socket_path
+
+    def make_connection(self, host):
+        return UnixHTTPConnection(self.socket_path)
+
+
+def run_client(socket_path, options):
+    """ hand the env file to a running daemon and report on its jobs.  returns
+        the exit status, or None if no daemon is listening on socket_path """
+    daemon = xmlrpclib.ServerProxy('http://localhost/', transport=UnixSocketTransport(socket_path), allow_none=True)
+    try:
+        daemon.status()
+    except (socket.error, httplib.HTTPException), e:
+        log.info("no mkvm daemon on %s (%s), running locally" % (socket_path, e))
+        return None
+
+    cfg = ConfigFile(options.vmfile)
+    if options.destroy and not options.skip_countdown:
+        print ''
+        print "DESTROYING %s" % ', '.join(cfg.configparser.sections())
+        print "##### YOU HAVE 5 SECONDS TO INTERUPT THIS WITH CTRL+C #####"
+        time.sleep(5)
+
+    job_options = { 'destroy' : bool(options.destroy),
+                    'replace' : bool(options.replace),
+                    'ignore' : bool(options.ignore),
+                    'reconcile' : bool(options.reconcile),
+                    'autostart' : bool(options.autostart),
+                    'add_to_cobbler' : options.add_to_cobbler,
+                    'cblr_username' : options.cblr_username or getpass.getuser(),
+                  }
+    batch_start = time.time()
+    try:
+        submitted = daemon.submit(os.path.abspath(options.vmfile), open(options.vmfile).read(), job_options, options.priority)
+    except xmlrpclib.Fault, e:
+        log.error("the mkvm daemon on %s did not take %s: %s" % (socket_path, options.vmfile, e.faultString))
+        return 1
+    except (socket.error, httplib.HTTPException), e:
+        log.error("lost the mkvm daemon on %s while submitting %s: %s" % (socket_path, options.vmfile, e))
+        return 1
+    vmnames = dict(submitted)
+    pending = vmnames.keys()
+    vm_results = {}
+    while pending:
+        try:
+            finished = daemon.wait(pending, 30)
+        except (xmlrpclib.Fault, socket.error, httplib.HTTPException), e:
+            # the jobs may still run, but there is nobody left to tell us how they went
+            log.error("lost the mkvm daemon on %s while waiting for %s: %s" % (socket_path, ', '.join(sorted([vmnames[job_id] for job_id in pending])), e))
+            for job_id in pending:
+                vm_results[vmnames[job_id]] = ('unknown', time.time() - batch_start, 'lost the daemon')
+            break
+        for job_id, vmname, status, seconds, detail in finished:
+            pending.remove(job_id)
+            vm_results[vmname] = (status, seconds, detail)
+            if status == 'failed':
+                log.error("provisioning %s failed: %s" % (vmname, detail))
+            elif status == 'skipped':
+                log.error("%s was skipped: %s" % (vmname, detail))
+            else:
+                log.info("%s %s in %.1fs" % (vmname, status, seconds))
+
+    if len(submitted) > 1:
+        print_summary([vmname for job_id, vmname in submitted], vm_results, time.time() - batch_start)
+    if [r for r in vm_results.values() if r[0] in ('failed', 'timed out', 'unknown')]:
+        return 1
+    return 0
+
+
+def print_summary(vmnames, results, elapsed):
+    """ print one line per VM and the totals for the whole batch """
+    print ''
+    print "%-40s %-10s %8s  %s" % ('VM', 'RESULT', 'TIME', 'DETAIL')
+    totals = {}
+    for vmname in vmnames:
+        status, seconds, detail = results.get(vmname, ('not run', 0, ''))
+        totals[status] = totals.get(status, 0) + 1
+        print "%-40s %-10s %7.1fs  %s" % (vmname, status, seconds, detail)
+
+    print ''
+    print "%i VMs in %.1fs: %s" % (len(vmnames), elapsed, ', '.join(["%i %s" % (totals[k], k) for k in sorted(totals)]))
 
 
 def get_options():
@@ -703,12 +3036,30 @@ def get_options():
                      help="Replace existing VMs with same hostname.  Assumes -i.  This will shutdown and delete ALL VMs with matching hostname.  Use with care.")
     optional.add_option("-i", "--ignore-existing-vm", action="store_true", dest="ignore",
                      help="Ignores possible conflicts, such as existing cobbler system profiles or existing duplicate VMs.")
+    optional.add_option("--reconcile", action="store_true", dest="reconcile", default=False,
+                     help="Change existing VMs to match the file (vcpus, memory, disk size, mgmt_classes) instead of skipping them, and create the missing ones.")
     optional.add_option("-d", "--destoy", action="store_true", dest="destroy",
                      help="Destoy VMs with matching names.  This is totally destructive, so use with care.")
     optional.add_option("-s", "--skip-countdown", action="store_true", dest="skip_countdown",
                      help="Skips the countdown before destroying VM.  Use this with -d to quickly destroy VMs.")
     optional.add_option("-t", "--template", action="store", dest="template_file", type="string",
                      help="Load templates from the given file.  Default: /etc/mkvm/templates")
+    optional.add_option("-P", "--parallel", action="store", dest="parallel", type="int", default=1, metavar="N",
+                     help="Provision up to N VMs at a time, each worker with its own XenAPI session.  Default: 1")
+    optional.add_option("--max-tasks", action="store", dest="max_tasks", type="int", default=16, metavar="N",
+                     help="Run at most N XenAPI tasks at a time when destroying VMs.  Default: 16")
+    optional.add_option("--boot-timeout", action="store", dest="boot_timeout", type="int", default=0, metavar="SECONDS",
+                     help="With -a, wait up to SECONDS for each VM to come up on the network (or power itself off).  A VM that does not counts as timed out, and mkvm exits with status 1.  Default: 0, follow each VM for up to max_install_time (see mkvm.conf) and count one that is not up by then as started")
+    optional.add_option("--placement", action="store", dest="placement", type="choice", choices=sorted(placement_strategies), metavar="STRATEGY",
+                     help="How to spread new VMs over the shared storage and hosts: spread, pack or weighted.  Default: spread")
+    optional.add_option("-D", "--daemon", action="store_true", dest="daemon", default=False,
+                     help="Run as a daemon that keeps its logins and XenServer cache warm and takes env files from mkvm clients.")
+    optional.add_option("--local", action="store_true", dest="local", default=False,
+                     help="Do the work in this process even if an mkvm daemon is running.")
+    optional.add_option("--trace", action="store", dest="trace", type="string", metavar="FILE",
+                     help="Time every XenAPI and cobbler call and each VM's phases, write the timeline to FILE (Chrome trace format) and print a summary at exit.")
+    optional.add_option("--priority", action="store", dest="priority", type="int", default=0, metavar="N",
+                     help="Priority of these VMs on an mkvm daemon's queue, higher runs first.  Default: 0")
 
     parser.add_option_group(required)
     parser.add_option_group(optional)
@@ -718,33 +3069,53 @@ def get_options():
         log.setLevel(logging.DEBUG)
         console.setLevel(logging.DEBUG)
 
+    if options.reconcile and (options.replace or options.destroy):
+        parser.error("--reconcile can not be used with -r or -d")
     if options.replace:
         options.ignore = True
-    if not options.vmfile:
+    if options.parallel < 1:
+        parser.error("--parallel must be at least 1")
+    if options.max_tasks < 1:
+        parser.error("--max-tasks must be at least 1")
+    if options.daemon and options.local:
+        parser.error("--daemon and --local can not be used together")
+    if not options.vmfile and not options.daemon:
         parser.print_help()
         sys.exit(-1)
 
+    if not options.template_file:
+        options.template_file = default_template_file
+
+    return options
+
+
+def prompt_cobbler_login(options):
+    """ ask for whatever cobbler credentials were not given on the command line """
     if options.add_to_cobbler:
         if not options.cblr_username:
             options.cblr_username = raw_input('Cobbler Username:')
         if not options.cblr_password:
             options.cblr_password = getpass.getpass('Cobbler Password:')
 
-    if not options.vmfile:
-        options.vmfile = default_config_file
-
-    if not options.template_file:
-        options.template_file = default_template_file
-
-    return options
-
 
 if __name__ == "__main__":
     log.debug("in __main__()")
     
     options = get_options()
     default_configs = ConfigFile(default_config_file)
-    
+    if options.trace:
+        instrument.recorder = instrument.Recorder()
+        atexit.register(instrument.finish, options.trace, lambda line: sys.stderr.write(line + '\n'))
+
+    daemon_socket = os.path.expanduser(default_configs.get_item('daemon_socket') or '~/.mkvm/mkvmd.sock')
+    if not options.daemon and not options.local and os.path.exists(daemon_socket):
+        # a running daemon already has everything logged in and cached
+        status = run_client(daemon_socket, options)
+        if status is not None:
+            sys.exit(status)
+
+    prompt_cobbler_login(options)
+
     xenserver = default_configs.get_item('xenserver')
     if not xenserver:
         xenserver = raw_input('XenServer (Hostname or IP): ')
@@ -756,92 +3127,167 @@ if __name__ == "__main__":
         xenserver_password = getpass.getpass('XenServer Password: ')
     if not xenserver.startswith('http'):
         xenserver = 'https://' + xenserver + '/'
+    xenapi_protocol = default_configs.get_item('xenapi_protocol') or 'xmlrpc'
+    if xenapi_protocol not in protocols:
+        log.error("xenapi_protocol must be one of %s" % ', '.join(protocols))
+        sys.exit(-1)
+    xenapi_gzip = (default_configs.get_item('xenapi_gzip') or '').lower() in ('yes', 'true', 'on', '1')
 
-    xenapi = xmlrpclib.Server(xenserver)
-    xensession = xenapi.session.login_with_password(xenserver_username, xenserver_password)['Value']
+    xenapi, xensession = xen_login(xenserver, xenserver_username, xenserver_password, xenapi_protocol, xenapi_gzip)
 
+    cblr = None
     cobbler_server = default_configs.get_item('cobbler_server')
     if options.add_to_cobbler:
         # connect to cobbler's xmlrpc API
-        cobbler = cobbler(cobbler_server, options)
+        cblr = cobbler(cobbler_server, options)
 
-    cfg = ConfigFile(options.vmfile) # user vm config.
     tmpl = ConfigFile(options.template_file) # default config templates.
-
-    xencache = XenCache(xensession)
-
-    vmlist = []
-    for vmname in cfg.configparser.sections():
-        log.debug("setting up %s" % vmname)
-        myvm = XenVM(vmname, xencache, xensession)
-
-        # cache some xen information so we don't have to query xenserver multiple times for the same data
-        myvm.sr_aggr = xencache._get_shared_storage
-        myvm.vm_template = xencache._get_xen_templates
-        
-        # apply configurations from either the template or user supplied values
-        myvm.configure(cfg, tmpl, cobbler_server)
-
-        log.debug("Created new XenVM object: %s" % str(myvm))
-
-        # if invoked to delete VMs, run through the input file and delete all matches
-        if options.destroy:
-            purge_vm(myvm, options, cobbler, xensession)
-            continue
-        
-        # warn the user before creating an identical VM
-        if myvm.is_existing_vm() and not options.ignore:
-            log.error('%s already exists. Aborting creation of %s. To ignore this and create it anyway, use -i. To REPLACE (destroy the existing and build a new one) this VM, use -r.' % \
-                (myvm.name, myvm.name))
-            time.sleep(2)
-            continue
-        else:
-            if options.replace:
-                purge_vm(myvm, options, cobbler, xensession)
-
-            myvm.set_ks_url(cobbler_server)
-            if options.add_to_cobbler:
-                log.info("Adding %s to cobbler" % myvm.name)
-                # add the new system to cobbler
-                cobbler.add_system_to_cobbler(myvm)
-            if options.autostart:
-                myvm.autostart = True
-            
-            # actually create the VM
-            myvm.create()
-
-            try:
-                activity_log = open(default_activity_log_file, 'a')
-                activity_log.write('%s: %s created VM %s\n' % (strftime("%Y-%m-%d %H:%M:%S"), options.cblr_username, myvm.name))
-                activity_log.close
-            except:
-		pass
-
-            # add FQDN to xenserver database
-	    xenapi.VM.add_to_other_config(self.xensession, self.vm_uuid, 'FQDN', myvm.fqdn)
-
-            # add the install repository location for kickstart
-            if options.add_to_cobbler:
-                log.debug("adding install repo to VM %s" % myvm.vm_uuid)
-                xenapi.VM.add_to_other_config(xensession, myvm.vm_uuid, 'install-repository', cobbler.query_install_repo(myvm.fqdn))
-                myvm.nics['eth0']['macaddress-eth0'] = myvm.mac_addr
-                cobbler.add_mac_to_cobbler(myvm)
-
-            if options.autostart:
-                log.info("sending start command to VM %s" % myvm.vm_uuid)
-                log.debug("first attempt to boot VM %s" % myvm.vm_uuid)
-                autostart_return = xenapi.VM.start(xensession, myvm.vm_uuid, False, True)
-		if autostart_return['Status'] == 'Failure':
-                    log.debug("first attempt failed. trying 2 more times...")
-                    log.debug("second attempt to boot VM %s" % myvm.vm_uuid)
-                    autostart_return = xenapi.VM.start(xensession, myvm.vm_uuid, False, True)
-                    if autostart_return == 'Failure':
-		        log.debug("second attempt failed. trying 1 more time...")
-                        log.debug("third attempt to boot VM %s" % myvm.vm_uuid)
-                        autostart_return = xenapi.VM.start(xensession, myvm.vm_uuid, False, True)
-                        if autostart_status == 'Failure':
-                            log.debug("third attempt failed. giving up.")
-                            log.warn("VM %s did not autoboot.  Please manually boot up the VM" % myvm.name)
-
-            log.info("VM %s successfully created." % myvm.name)
-	    xenapi.session.logout(xensession)
+    if options.daemon:
+        # env files only arrive later, so start from the templates' VMs and storage
+        cfg = None
+        configs = (tmpl,)
+    else:
+        cfg = ConfigFile(options.vmfile) # user vm config.
+        configs = (cfg, tmpl)
+
+    # template types with a warm pool, and how many VMs each keeps ready
+    warm_sizes = {}
+    for entry in (default_configs.get_item('warm_pool') or '').split():
+        vmtype, size = entry.split(':')
+        if not tmpl.configparser.has_section(vmtype):
+            log.error("warm_pool names type '%s', which is not in %s" % (vmtype, options.template_file))
+            sys.exit(-1)
+        warm_sizes[vmtype] = int(size)
+
+    # every VM, template and storage type the env file can end up using
+    vm_names, storage_types = cfg and cfg.configparser.sections() or [], []
+    vm_names.extend(['mkvm-warm-%s' % warm_type for warm_type in warm_sizes])
+    for config in configs:
+        for section in config.configparser.sections():
+            if config.configparser.has_option(section, 'vm_template'):
+                vm_names.append(config.configparser.get(section, 'vm_template'))
+            if config.configparser.has_option(section, 'storage'):
+                storage_types.append(config.configparser.get(section, 'storage'))
+
+    xencache_file = default_configs.get_item('xencache_file')
+    if xencache_file:
+        # one snapshot per pool
+        xencache_file = '%s.%s' % (os.path.expanduser(xencache_file), xenserver.split('/')[2])
+        xencache = XenCache(xenapi, xensession, xencache_file, storage_types=storage_types)
+    elif options.daemon:
+        # the daemon does not know which VMs it will be asked about, so it keeps them all
+        xencache = XenCache(xenapi, xensession, storage_types=storage_types)
+    else:
+        xencache = XenCache(xenapi, xensession, vm_names=vm_names, storage_types=storage_types)
+    registrar = None
+    cobbler_cache = None
+    if options.add_to_cobbler:
+        # every system in one request, for the conflict checks and MAC allocation
+        cobbler_cache = CobblerCache(cblr)
+        # the registrar gets a connection of its own, since it runs on its own thread
+        registrar = CobblerRegistrar(cobbler(cobbler_server, options), (options.parallel > 1 or options.daemon) and 0.25 or 0.0, cobbler_cache)
+        registrar.start()
+
+    macs = MacAllocator(xencache, default_configs.get_item('mac_oui') or '00:16:3e', default_configs.get_item('mac_range') or '00:00:00-ff:ff:ff', cobbler_cache)
+    install_repos = None
+    if options.add_to_cobbler:
+        install_repo_cache = default_configs.get_item('install_repo_cache')
+        if install_repo_cache:
+            # one cache per cobbler server
+            install_repo_cache = '%s.%s' % (os.path.expanduser(install_repo_cache), cobbler_server.replace('/', '_'))
+        install_repo_ttl = default_configs.get_item('install_repo_ttl')
+        if install_repo_ttl in (None, ''):
+            install_repo_ttl = 3600
+        install_repos = InstallRepoResolver(install_repo_cache, int(install_repo_ttl))
+    try:
+        planner = PlacementPlanner(xencache, options.placement or default_configs.get_item('placement_strategy') or 'spread')
+    except ValueError, e:
+        log.error(e)
+        sys.exit(-1)
+    warm_pool = None
+    if warm_sizes:
+        warm_pool = WarmPool(xencache, tmpl, warm_sizes)
+    journal = None
+    if default_configs.get_item('journal_dir'):
+        journal = StepJournal(default_configs.get_item('journal_dir'))
+
+    def worker_connect():
+        """ private XenAPI session and cobbler connection for one worker """
+        worker_xenapi, worker_xensession = xen_login(xenserver, xenserver_username, xenserver_password, xenapi_protocol, xenapi_gzip)
+        worker_cblr = None
+        if options.add_to_cobbler:
+            worker_cblr = cobbler(cobbler_server, options)
+        return worker_xenapi, worker_xensession, worker_cblr
+
+    def xen_connect():
+        """ a XenAPI session for a background thread """
+        return xen_login(xenserver, xenserver_username, xenserver_password, xenapi_protocol, xenapi_gzip)
+
+    # autostarted VMs are booted at the pace the install infrastructure can take
+    max_install_time = default_configs.get_item('max_install_time')
+    if max_install_time in (None, ''):
+        max_install_time = 1800
+    boots = BootScheduler(xen_connect, int(default_configs.get_item('max_installing') or 10),
+                          float(default_configs.get_item('boot_rate') or 0), options.boot_timeout, int(max_install_time))
+    boots.start()
+
+    if options.daemon:
+        # load everything now rather than on the first client's time
+        xencache._get_all_vm_records()
+        xencache._get_all_sr_records()
+        xencache._get_all_vif_records()
+        daemon = ProvisionDaemon(options, xencache, planner, tmpl, xen_connect, int(default_configs.get_item('daemon_refresh') or 10), journal, cobbler_cache)
+        for i in range(options.parallel):
+            ProvisionWorker(daemon.jobs, tmpl, xencache, macs, registrar, cobbler_server, worker_connect, True, warm_pool, boots, install_repos).start()
+        if warm_pool:
+            WarmPoolFiller(warm_pool, planner, macs, xen_connect, float(default_configs.get_item('warm_pool_headroom') or 0.2)).start()
+        if not os.path.isdir(os.path.dirname(daemon_socket)):
+            os.makedirs(os.path.dirname(daemon_socket), 0700)
+        try:
+            daemon.serve(daemon_socket)
+        except KeyboardInterrupt:
+            log.info("mkvm daemon shutting down")
+        if registrar:
+            registrar.stop()
+        xencache.xenapi.session.logout(xencache.xensession)
+        sys.exit(0)
+
+    vmnames = cfg.configparser.sections()
+    jobs, results = Queue.PriorityQueue(), Queue.Queue()
+    batch = [ProvisionJob(vmname, cfg, options, results, journal=journal) for vmname in vmnames]
+    planner.plan_jobs(batch, tmpl)
+    for sequence, job in enumerate(batch):
+        jobs.put((0, sequence, job))
+
+    batch_start = time.time()
+    if options.parallel > 1:
+        workers = []
+        for i in range(min(options.parallel, len(vmnames))):
+            worker = ProvisionWorker(jobs, tmpl, xencache, macs, registrar, cobbler_server, worker_connect, warm_pool=warm_pool, boots=boots, install_repos=install_repos)
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            # join with a timeout so ctrl+c still reaches the main thread
+            while worker.isAlive():
+                worker.join(1)
+    else:
+        worker = ProvisionWorker(jobs, tmpl, xencache, macs, registrar, cobbler_server, None, warm_pool=warm_pool, boots=boots, install_repos=install_repos)
+        worker.xenapi, worker.xensession, worker.cblr = xenapi, xensession, cblr
+        worker.run_jobs()
+    # the last VMs may still be booting
+    boots.drain()
+
+    if registrar:
+        registrar.stop()
+    xenapi.session.logout(xensession)
+
+    vm_results = {}
+    while not results.empty():
+        job, status, seconds, detail = results.get()
+        vm_results[job.vmname] = (status, seconds, detail)
+
+    if options.parallel > 1 or options.autostart:
+        print_summary(vmnames, vm_results, time.time() - batch_start)
+
+    if [r for r in vm_results.values() if r[0] in ('failed', 'timed out')]:
+        sys.exit(1)
@@ -1,17 +1,41 @@
 #!/usr/bin/python
 
+import atexit
+import ConfigParser
+import heapq
+import signal
 import time
 import xmlrpclib
 import logging
 import sys
 
+import instrument
+from xentasks import ObjectGraph, Teardown
+from xentransport import xenapi_proxy
+
 xen_server = 'https://foo.example.com'
 xen_user = 'root'
 xen_password = 'password'
+# 'xmlrpc', or 'jsonrpc' on XenServer 7.3 and later, which is much cheaper to
+# parse.  gzip trades a little CPU on both ends for far fewer bytes on the wire
+xen_protocol = 'xmlrpc'
+xen_gzip = False
 
 global_log_level = logging.WARN
 default_log_file = '/var/log/mkvm/vm-zamboni.log'
 default_activity_log_file = '/var/log/mkvm/activity.log'
+# mkvm's templates, for the names of the golden images
+template_file = '/etc/mkvm/templates'
+# longest single event.from wait.  with nothing due for hours zamboni still
+# wakes up this often, which keeps the connection and session from going stale
+max_wait = 300.0
+# most XenAPI tasks to run at once while destroying expired VMs
+teardown_concurrency = 16
+# how long to back off after losing the connection to the pool master
+retry_wait = 30.0
+# time every XenAPI call and purge, and write the timeline here (Chrome
+# trace format) with a summary on stderr when zamboni exits.  None to not
+trace_file = None
 default_log_format = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 
 logging.basicConfig(filename=default_log_file,
@@ -28,71 +52,212 @@ logging.getLogger("v-zambonim").addHandler(console)
 log = logging.getLogger("vm-zamboni")
 log.debug("Starting log")
 
-while True:
-    xenapi = xmlrpclib.Server(xen_server)
+
+
+def xen_login():
+    xenapi = xenapi_proxy(xen_server, xen_protocol, xen_gzip, instrument.recorder)
     xensession = xenapi.session.login_with_password(xen_user, xen_password)['Value']
+    return xenapi, xensession
+
+
+def get_expiry(record):
+    """ the expiry time of a VM record, or None if it never expires """
+    if record['is_control_domain'] or 'expiry' not in record['other_config']:
+        return None
+    try:
+        return int(record['other_config']['expiry'])
+    except ValueError:
+        log.warn("VM %s has an invalid expiry %r, ignoring it" % (record['name_label'], record['other_config']['expiry']))
+        return None
+
+
+class ExpiryQueue:
+    """ expiry times of every VM in the pool, soonest first.
+
+        entries are never removed from the heap when a VM's expiry changes or
+        the VM goes away; expiries holds the current expiry of each VM and heap
+        entries that disagree with it are dropped when they reach the top. """
+
+    def __init__(self):
+        self.heap = []
+        self.expiries = {}
+
+    def update(self, vm_ref, record):
+        """ record the current state of a VM.  record is None for a deleted VM """
+        expiry = record and get_expiry(record)
+        if expiry is None:
+            self.expiries.pop(vm_ref, None)
+        elif self.expiries.get(vm_ref) != expiry:
+            self.expiries[vm_ref] = expiry
+            heapq.heappush(self.heap, (expiry, vm_ref))
+
+    def _discard_stale(self):
+        while self.heap and self.expiries.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+    def next_expiry(self):
+        self._discard_stale()
+        if self.heap:
+            return self.heap[0][0]
+        return None
+
+    def pop_expired(self, now):
+        """ remove and return the refs of the VMs whose expiry is not after now """
+        expired = []
+        while self.next_expiry() is not None and self.heap[0][0] <= now:
+            expiry, vm_ref = heapq.heappop(self.heap)
+            del self.expiries[vm_ref]
+            expired.append(vm_ref)
+        return expired
+
+
+def snapshot(xenapi, xensession):
+    """ an event.from token and every VM record in the pool.  the token is None
+        on servers without event.from, which are polled every max_wait instead """
+    events = getattr(xenapi.event, 'from')(xensession, ['vm'], '', 0.0)
+    if events['Status'] == 'Success':
+        records = {}
+        for event in events['Value']['events']:
+            if event['operation'] != 'del' and 'snapshot' in event:
+                records[event['ref']] = event['snapshot']
+        return events['Value']['token'], records
+    log.debug("event.from is not available (%s), polling VM.get_all_records instead" % events['ErrorDescription'])
+    return None, xenapi.VM.get_all_records(xensession)['Value']
+
+
+def golden_images():
+    """ the names of the golden images the templates build VMs from.  no VM
+        uses them, so they look just like orphaned disks """
+    templates = ConfigParser.ConfigParser()
+    try:
+        templates.read(template_file)
+    except ConfigParser.Error, e:
+        log.warn("unable to read golden image names from %s: %s" % (template_file, e))
+    images = set()
+    for section in templates.sections():
+        if templates.has_option(section, 'image') and templates.get(section, 'image') != 'none':
+            images.add(templates.get(section, 'image'))
+    return images
+
+
+class OrphanReport:
+    """ warn about disks and VIFs that earlier, interrupted purges left behind.
+        mkvm creates a VM's disk a moment before attaching it, so something is
+        only reported once it has shown up as an orphan in two graphs in a row,
+        and only once until it is cleaned up.  the golden images named in
+        images are never reported """
+
+    def __init__(self, images=()):
+        self.images = images
+        self.suspects = set()
+        self.reported = set()
+
+    def check(self, graph, vm_refs):
+        vdis, vifs = graph.orphans(vm_refs, self.images)
+        found = set(vdis + vifs)
+        for vdi in vdis:
+            if vdi in self.suspects and vdi not in self.reported:
+                record = graph.vdis[vdi]
+                log.warn("VDI %s (%s, uuid %s, SR %s) is not attached to any VM" % (vdi, record['name_label'], record['uuid'], record['SR']))
+        for vif in vifs:
+            if vif in self.suspects and vif not in self.reported:
+                record = graph.vifs[vif]
+                log.warn("VIF %s (MAC %s, uuid %s) belongs to VM %s, which no longer exists" % (vif, record['MAC'], record['uuid'], record['VM']))
+        self.reported = (self.reported | self.suspects) & found
+        self.suspects = found
+
+
+def purge_vms(xenapi, xensession, records, vm_refs, orphans):
+    """ destroy the given VMs together.  the devices of all of them come from
+        one graph of the pool, which is also checked for orphans """
+    purge_span = instrument.span('purge', vms=len(vm_refs))
+    graph = ObjectGraph(xenapi, xensession)
+    orphans.check(graph, records)
+
+    teardown = Teardown(xenapi, xensession, teardown_concurrency, graph)
+    for vm_ref in vm_refs:
+        activity_log = open(default_activity_log_file, 'a')
+        activity_log.write('%s: %s purged VM %s\n' % (time.strftime("%Y-%m-%d %H:%M:%S"), "vm-zamboni", records[vm_ref]['name_label']))
+        activity_log.close()
+        teardown.add_vm(vm_ref)
+
+    for vm_ref, errors in teardown.run().items():
+        for label, error in sorted(errors.items()):
+            log.debug("%s failed (%s). Assuming it is already done..." % (label, ' '.join(error)))
+        log.info("VM (%s) was destroyed" % records[vm_ref]['name_label'])
+    purge_span.end()
+
+
+def run(xenapi, xensession):
+    """ build the expiry queue from one snapshot of the pool, then keep it
+        current with event.from and purge each VM as soon as it expires.
+        returns only by raising, e.g. when the connection is lost """
+    snapshot_span = instrument.span('snapshot')
+    token, records = snapshot(xenapi, xensession)
+    snapshot_span.end()
+    expiries = ExpiryQueue()
+    for vm_ref, record in records.items():
+        expiries.update(vm_ref, record)
+    log.debug("watching %i VMs, %i of them with an expiry" % (len(records), len(expiries.expiries)))
+    orphans = OrphanReport(golden_images())
+    orphan_span = instrument.span('orphan check')
+    orphans.check(ObjectGraph(xenapi, xensession), records)
+    orphan_span.end()
+
+    while True:
+        expired = expiries.pop_expired(int(time.time()))
+        if expired:
+            purge_vms(xenapi, xensession, records, expired, orphans)
+
+        next_expiry = expiries.next_expiry()
+        if next_expiry is None:
+            wait = max_wait
+        else:
+            wait = min(max(next_expiry - time.time(), 0.0), max_wait)
+
+        if token is None:
+            time.sleep(wait)
+            records = xenapi.VM.get_all_records(xensession)['Value']
+            expiries = ExpiryQueue()
+            for vm_ref, record in records.items():
+                expiries.update(vm_ref, record)
+            continue
+
+        # event.from returns as soon as any VM changes, or after wait seconds
+        events = getattr(xenapi.event, 'from')(xensession, ['vm'], token, float(wait))
+        if events['Status'] != 'Success':
+            raise xmlrpclib.Fault(0, "event.from failed: %s" % events['ErrorDescription'])
+        token = events['Value']['token']
+        for event in events['Value']['events']:
+            if event['operation'] == 'del':
+                records.pop(event['ref'], None)
+                expiries.update(event['ref'], None)
+            elif 'snapshot' in event:
+                records[event['ref']] = event['snapshot']
+                expiries.update(event['ref'], event['snapshot'])
+
+
+if trace_file:
+    instrument.recorder = instrument.Recorder()
+    atexit.register(instrument.finish, trace_file, lambda line: sys.stderr.write(line + '\n'))
+    # a plain kill should leave a trace behind too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+while True:
+    try:
+        xenapi, xensession = xen_login()
+    except Exception, e:
+        log.warn("could not log in to %s: %s" % (xen_server, e))
+        time.sleep(retry_wait)
+        continue
+
+    try:
+        run(xenapi, xensession)
+    except Exception, e:
+        log.warn("lost track of the pool (%s), starting over from a new snapshot" % e)
 
-    date = int(time.time())
-    all_vm_records = xenapi.VM.get_all_records(xensession)['Value']
-
-    for vm_uuid in all_vm_records:
-        if not all_vm_records[vm_uuid]['is_control_domain']:
-            if 'expiry' in all_vm_records[vm_uuid]['other_config']:
-                if int(all_vm_records[vm_uuid]['other_config']['expiry']) < date:
-                    activity_log = open(default_activity_log_file, 'a')
-                    activity_log.write('%s: %s purged VM %s\n' % (time.strftime("%Y-%m-%d %H:%M:%S"), "vm-zamboni", all_vm_records[vm_uuid]['name_label']))
-                    activity_log.close
-
-		    vmcache = xenapi.VM.get_record(xensession, vm_uuid)['Value']
-                    vbd, vif, VDIs = [], [], []
-                    VBDs = vmcache['VBDs']
-                    VIFs = vmcache['VIFs']
-                    log.info('sending power off command to VM %s' % vm_uuid) 
-                    try:
-                        log.debug("powering off %s" % vm_uuid)
-                        xenapi.VM.hard_shutdown(xensession, vm_uuid)
-                    except:
-                        log.debug("power off command failed. Assuming VM is already shutdown...")
-                    pass
-                    
-                    for uuid in VBDs:
-                        VDIs.append(xenapi.VBD.get_record(xensession, uuid)['Value']['VDI'])
-                        log.info('sending destroy command for VBD %s' % uuid)
-                        try:
-                            log.debug("destroying VBD %s" % uuid)
-                            xenapi.VBD.destroy(xensession, uuid)
-                        except:
-                            log.debug("VBD destroy command failed. Assuming VBD is already destroyed...")
-                            pass
-                    
-                    for uuid in VIFs:
-                        log.info('sending destroy command for VIF %s' % uuid)
-                        try:
-                            log.debug("destroying VIF %s" % uuid)
-                            xenapi.VIF.destroy(xensession, uuid)
-                        except:
-                            log.debug("VIF destroy command failed. Assuming VIF is already destroyed...")
-                            pass
-                    
-                    for uuid in VDIs:
-                        log.info('sending destroy command for VDI %s' % uuid)
-                        try:
-                            log.debug("destroying VDI %s" % uuid)
-                            xenapi.VDI.destroy(xensession, uuid)
-                        except:
-                            log.debug("VDI destroy command failed.  Assuming VDI is already destroyed...")
-                            pass
-                    
-                    log.info('sending destroy command for VM %s' % vm_uuid)
-                    try:
-                        log.debug("destroying VM %s" % vm_uuid)
-                        xenapi.VM.destroy(xensession, vm_uuid)
-                    except:
-                        log.debug("VM destroy command failed.  Assuming VM is already destroyed...")
-                        pass
-                    
-                    log.info("VM (%s) was destroyed" % vmcache['name_label'])
-
-    xenapi.session.logout(xensession)
-
-    time.sleep(300)
+    try:
+        xenapi.session.logout(xensession)
+    except Exception:
+        pass
+    time.sleep(retry_wait)
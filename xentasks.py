@@ -0,0 +1,357 @@
+#============================================================================
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of version 3.0 of the GNU General Public
+# License as published by the Free Software Foundation.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#============================================================================
+# Copyright (C) 2010 David Wahlstrom
+# Copyright (C) 2010 Brett Lentz
+#============================================================================
+#
+# XenAPI task helpers shared by mkvm.py and vm-zamboni.py
+
+import json
+import logging
+import time
+import xmlrpclib
+
+log = logging.getLogger("xentasks")
+
+
+class XenTaskError(Exception):
+    """ one or more XenAPI tasks failed.  errors maps each task label to its error_info """
+
+    def __init__(self, errors):
+        Exception.__init__(self, '; '.join(["%s: %s" % (k, ' '.join(v)) for k, v in sorted(errors.items())]))
+        self.errors = errors
+
+
+class XenTasks:
+    """ submit XenAPI Async.* calls and wait for them together.  xapi works on
+        all submitted tasks at once, so a batch of slow storage operations costs
+        about as long as the slowest of them instead of the sum """
+
+    poll_interval = 0.5
+
+    def __init__(self, xenapi, xensession, max_pending=None, on_finish=None):
+        """ at most max_pending tasks run at once, the rest are queued until
+            earlier ones finish.  on_finish(label) is called as each task
+            succeeds or fails, and may submit more tasks """
+        self.xenapi = xenapi
+        self.xensession = xensession
+        self.max_pending = max_pending
+        self.on_finish = on_finish
+        self.pending = {}
+        self.queued = []
+        self.results = {}
+        self.errors = {}
+
+    def submit(self, label, method, *args):
+        """ start Async.<method> (i.e. 'VM.clone') and remember it as label.
+            a call that is refused outright is reported by wait() like any other
+            failure.  returns the task, or None if the call was queued or refused """
+        if self.max_pending and len(self.pending) >= self.max_pending:
+            log.debug("queueing task %s: Async.%s" % (label, method))
+            self.queued.append((label, method, args))
+            return None
+        log.debug("submitting task %s: Async.%s" % (label, method))
+        call = self.xenapi.Async
+        for name in method.split('.'):
+            call = getattr(call, name)
+        task = call(self.xensession, *args)
+        if task['Status'] != 'Success':
+            self.errors[label] = task['ErrorDescription']
+            self._finished(label)
+            return None
+        self.pending[task['Value']] = label
+        return task['Value']
+
+    def _finished(self, label):
+        if self.on_finish:
+            self.on_finish(label)
+        while self.queued and len(self.pending) < self.max_pending:
+            label, method, args = self.queued.pop(0)
+            self.submit(label, method, *args)
+
+    def _parse_result(self, result):
+        """ task results come back as an xml-rpc <value> fragment, or as JSON
+            when the task was submitted over JSON-RPC """
+        if not result:
+            return ''
+        if not result.startswith('<'):
+            try:
+                return json.loads(result)
+            except ValueError:
+                return result
+        return xmlrpclib.loads('<methodResponse><params><param>%s</param></params></methodResponse>' % result)[0][0]
+
+    def _finish(self, task, record):
+        label = self.pending.pop(task)
+        if record['status'] == 'success':
+            self.results[label] = self._parse_result(record['result'])
+            log.debug("task %s finished: %s" % (label, self.results[label]))
+        else:
+            self.errors[label] = record['error_info'] or [record['status']]
+            log.debug("task %s failed: %s" % (label, self.errors[label]))
+        self.xenapi.task.destroy(self.xensession, task)
+        self._finished(label)
+
+    def _poll(self):
+        """ fallback for servers without event.from: check each pending task """
+        for task in self.pending.keys():
+            record = self.xenapi.task.get_record(self.xensession, task)['Value']
+            if record['status'] != 'pending':
+                self._finish(task, record)
+        if self.pending:
+            time.sleep(self.poll_interval)
+
+    def wait(self, ignore_errors=False, timeout=3600):
+        """ block until every submitted task is done and return the results of all
+            tasks so far, keyed by label.  unless ignore_errors is set, raise
+            XenTaskError if any of them failed """
+        deadline = time.time() + timeout
+        token = ''
+        event_from = getattr(self.xenapi.event, 'from')
+        while self.pending:
+            if time.time() > deadline:
+                raise XenTaskError(dict([(label, ['TIMEOUT']) for label in self.pending.values() + [queued[0] for queued in self.queued]]))
+            if token is None:
+                self._poll()
+                continue
+
+            # an empty token returns the current state of every task, later calls only what changed
+            events = event_from(self.xensession, ['task'], token, 30.0)
+            if events['Status'] != 'Success':
+                log.debug("event.from is not available (%s), polling tasks instead" % events['ErrorDescription'])
+                token = None
+                continue
+            token = events['Value']['token']
+            for event in events['Value']['events']:
+                if event['ref'] in self.pending and 'snapshot' in event:
+                    log.debug("task %s is %i%% done" % (self.pending[event['ref']], int(float(event['snapshot']['progress']) * 100)))
+                    if event['snapshot']['status'] != 'pending':
+                        self._finish(event['ref'], event['snapshot'])
+
+        if self.errors and not ignore_errors:
+            errors, self.errors = self.errors, {}
+            raise XenTaskError(errors)
+        return self.results
+
+
+class XenBatch:
+    """ XenAPI calls that don't depend on each other, sent together.  where the
+        server has system.multicall the whole batch is one round trip, otherwise
+        the calls are made one at a time """
+
+    # whether the server has system.multicall, shared by every batch once one finds out
+    multicall = None
+
+    def __init__(self, xenapi, xensession):
+        self.xenapi = xenapi
+        self.xensession = xensession
+        self.calls = []
+        self.results = {}
+        self.errors = {}
+
+    def add(self, label, method, *args):
+        """ queue <method> (i.e. 'VM.set_PV_args') as label.  calls run in the order they are added """
+        self.calls.append((label, method, args))
+
+    def _multicall(self, calls):
+        """ the response to every call, or None if the server has no system.multicall """
+        calls = [{ 'methodName' : method, 'params' : [self.xensession] + list(args) } for label, method, args in calls]
+        try:
+            responses = self.xenapi.system.multicall(calls)
+        except xmlrpclib.Fault, e:
+            log.debug("system.multicall is not available (%s), making the calls one at a time" % e.faultString)
+            return None
+        if isinstance(responses, dict):
+            log.debug("system.multicall is not available (%s), making the calls one at a time" % responses.get('ErrorDescription'))
+            return None
+
+        results = []
+        for response in responses:
+            if isinstance(response, dict):
+                results.append({ 'Status' : 'Failure', 'ErrorDescription' : ['XMLRPC_FAULT', str(response['faultCode']), response['faultString']] })
+            else:
+                results.append(response[0])
+        return results
+
+    def send(self, ignore_errors=False):
+        """ make every queued call and return the values of all calls so far,
+            keyed by label.  unless ignore_errors is set, raise XenTaskError if
+            any of them failed """
+        calls, self.calls = self.calls, []
+        responses = None
+        if calls and XenBatch.multicall is not False:
+            responses = self._multicall(calls)
+            XenBatch.multicall = responses is not None
+        if responses is None:
+            responses = []
+            for label, method, args in calls:
+                call = self.xenapi
+                for name in method.split('.'):
+                    call = getattr(call, name)
+                responses.append(call(self.xensession, *args))
+
+        for (label, method, args), response in zip(calls, responses):
+            if response['Status'] == 'Success':
+                self.results[label] = response['Value']
+            else:
+                self.errors[label] = response['ErrorDescription']
+                log.debug("%s (%s) failed: %s" % (label, method, response['ErrorDescription']))
+
+        if self.errors and not ignore_errors:
+            errors, self.errors = self.errors, {}
+            raise XenTaskError(errors)
+        return self.results
+
+
+class ObjectGraph:
+    """ the VBDs, VIFs and VDIs of the pool joined into VM -> VBD -> VDI and
+        VM -> VIF, fetched with one call per class instead of one per device.
+
+        with vm_refs, only the VBDs and VIFs of those VMs are fetched (two
+        get_all_records_where calls), which is all a teardown needs.  without
+        it every VBD, VIF and VDI in the pool is fetched, which also allows
+        looking for orphans. """
+
+    def __init__(self, xenapi, xensession, vm_refs=None):
+        self.vdis = {}
+        if vm_refs is not None:
+            where = ' or '.join(['field "VM" = "%s"' % vm_ref for vm_ref in vm_refs])
+            self.vbds = self._get_records(xenapi, xensession, 'VBD', where)
+            self.vifs = self._get_records(xenapi, xensession, 'VIF', where)
+        else:
+            self.vbds = self._get_records(xenapi, xensession, 'VBD')
+            self.vifs = self._get_records(xenapi, xensession, 'VIF')
+            self.vdis = self._get_records(xenapi, xensession, 'VDI')
+
+        self.vbds_by_vm, self.vifs_by_vm = {}, {}
+        for vbd, record in self.vbds.items():
+            self.vbds_by_vm.setdefault(record['VM'], []).append(vbd)
+        for vif, record in self.vifs.items():
+            self.vifs_by_vm.setdefault(record['VM'], []).append(vif)
+
+    def _get_records(self, xenapi, xensession, cls, where=None):
+        if where is not None:
+            if not where:
+                return {}
+            records = getattr(xenapi, cls).get_all_records_where(xensession, where)
+            if records['Status'] == 'Success':
+                return records['Value']
+            log.debug("%s.get_all_records_where is not available (%s), fetching every %s" % (cls, records['ErrorDescription'], cls))
+        records = getattr(xenapi, cls).get_all_records(xensession)
+        if records['Status'] != 'Success':
+            raise XenTaskError({ '%s.get_all_records' % cls : records['ErrorDescription'] })
+        return records['Value']
+
+    def disks(self, vm_ref):
+        """ (vbd, vdi) for each VBD of the VM.  vdi is None for an empty drive and
+            for a CD drive, whose VDI is an ISO in a shared library and not the VM's """
+        disks = []
+        for vbd in self.vbds_by_vm.get(vm_ref, []):
+            vdi = self.vbds[vbd]['VDI']
+            if vdi == 'OpaqueRef:NULL' or self.vbds[vbd]['type'] == 'CD':
+                vdi = None
+            disks.append((vbd, vdi))
+        return disks
+
+    def vifs_of(self, vm_ref):
+        return self.vifs_by_vm.get(vm_ref, [])
+
+    def orphans(self, vm_refs, images=()):
+        """ system disks attached to nothing and VIFs of VMs that no longer exist,
+            i.e. what an interrupted teardown leaves behind.  vm_refs are the VMs
+            that do exist, images the names of golden images, which are never
+            attached.  only meaningful for a graph of the whole pool """
+        vdis = []
+        for vdi, record in self.vdis.items():
+            if record['type'] == 'system' and record['managed'] and not record['is_a_snapshot'] and not record['VBDs'] \
+                    and record['name_label'] not in images:
+                vdis.append(vdi)
+        vifs = [vif for vif, record in self.vifs.items() if record['VM'] not in vm_refs]
+        return vdis, vifs
+
+
+class Teardown:
+    """ destroy VMs along with their disks and network interfaces.
+
+        each VM is a small dependency graph: power off, then destroy its VBDs
+        and VIFs, then the VDIs behind those VBDs and the VM itself.  a step is
+        started as soon as the steps it depends on are done, so one VM's disks
+        are being destroyed while another is still powering off, with at most
+        max_pending xapi tasks at a time.  failures are expected (the VM may
+        already be halted, a disk already gone), so a failed step is recorded
+        and its dependents are started anyway. """
+
+    def __init__(self, xenapi, xensession, max_pending=16, graph=None):
+        """ graph is an ObjectGraph that covers the VMs to destroy.  without
+            one, a graph of just those VMs is fetched when the teardown runs """
+        self.xenapi = xenapi
+        self.xensession = xensession
+        self.max_pending = max_pending
+        self.graph = graph
+        self.vms = []
+
+    def add_vm(self, vm_ref):
+        self.vms.append(vm_ref)
+
+    def _add_step(self, vm_ref, label, method, target, depends_on):
+        # a VDI attached to two of the VMs waits for both VBDs
+        self.steps.setdefault(label, (vm_ref, method, target))
+        self.waiting_on.setdefault(label, set()).update(depends_on)
+        for dependency in depends_on:
+            self.dependents.setdefault(dependency, []).append(label)
+
+    def _build(self):
+        self.steps, self.waiting_on, self.dependents = {}, {}, {}
+        if self.graph is None:
+            self.graph = ObjectGraph(self.xenapi, self.xensession, self.vms)
+        for vm_ref in self.vms:
+            power_off = 'power off VM %s' % vm_ref
+            self._add_step(vm_ref, power_off, 'VM.hard_shutdown', vm_ref, [])
+            devices = []
+            for vbd, vdi in self.graph.disks(vm_ref):
+                devices.append('destroy VBD %s' % vbd)
+                self._add_step(vm_ref, devices[-1], 'VBD.destroy', vbd, [power_off])
+                if vdi:
+                    self._add_step(vm_ref, 'destroy VDI %s' % vdi, 'VDI.destroy', vdi, [devices[-1]])
+            for vif in self.graph.vifs_of(vm_ref):
+                devices.append('destroy VIF %s' % vif)
+                self._add_step(vm_ref, devices[-1], 'VIF.destroy', vif, [power_off])
+            self._add_step(vm_ref, 'destroy VM %s' % vm_ref, 'VM.destroy', vm_ref, [power_off] + devices)
+
+    def _start(self, label):
+        vm_ref, method, target = self.steps[label]
+        log.info('sending %s' % label)
+        self.tasks.submit(label, method, target)
+
+    def _step_done(self, label):
+        for dependent in self.dependents.get(label, []):
+            self.waiting_on[dependent].discard(label)
+            if not self.waiting_on[dependent]:
+                self._start(dependent)
+
+    def run(self, timeout=3600):
+        """ destroy every VM added so far.  returns the failed steps of each VM,
+            {vm_ref: {label: error_info}}, with an empty dict for a clean teardown """
+        self._build()
+        self.tasks = XenTasks(self.xenapi, self.xensession, self.max_pending, self._step_done)
+        for label in self.steps.keys():
+            if not self.waiting_on[label]:
+                self._start(label)
+        self.tasks.wait(ignore_errors=True, timeout=timeout)
+
+        errors = dict([(vm_ref, {}) for vm_ref in self.vms])
+        for label, error in self.tasks.errors.items():
+            errors[self.steps[label][0]][label] = error
+        return errors
@@ -0,0 +1,165 @@
+#============================================================================
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of version 3.0 of the GNU General Public
+# License as published by the Free Software Foundation.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#============================================================================
+# Copyright (C) 2010 David Wahlstrom
+# Copyright (C) 2010 Brett Lentz
+#============================================================================
+#
+# XenAPI connections shared by mkvm.py and vm-zamboni.py: one persistent
+# HTTP/1.1 connection per proxy, optional gzip, and either XML-RPC or the
+# JSON-RPC endpoint xapi serves on /jsonrpc.  both kinds of proxy return
+# the usual { 'Status', 'Value' | 'ErrorDescription' } structs.
+
+import errno
+import gzip
+import httplib
+import json
+import logging
+import socket
+import urlparse
+import xmlrpclib
+import zlib
+from cStringIO import StringIO
+
+log = logging.getLogger("xentransport")
+
+protocols = ['xmlrpc', 'jsonrpc']
+
+
+class Connection:
+    """ a keep-alive HTTP connection to the pool master.  it is opened on the
+        first request and opened again when the server has dropped it """
+
+    # request bodies smaller than this are not worth compressing
+    gzip_threshold = 1400
+
+    def __init__(self, url, use_gzip=False):
+        scheme, self.host, self.path = urlparse.urlsplit(url)[:3]
+        if scheme not in ('http', 'https'):
+            raise ValueError("unsupported XenAPI url %s" % url)
+        self.secure = scheme == 'https'
+        self.use_gzip = use_gzip
+        self.connection = None
+        # bytes on the wire, both ways, for the instrumentation
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def _connect(self):
+        if self.connection is None:
+            if self.secure:
+                self.connection = httplib.HTTPSConnection(self.host)
+            else:
+                self.connection = httplib.HTTPConnection(self.host)
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def _send(self, path, body, headers):
+        """ send the request, once more on a new connection if an idle one turns out to be closed """
+        for attempt in (0, 1):
+            reused = self.connection is not None
+            try:
+                connection = self._connect()
+                connection.request('POST', path, body, headers)
+                return connection.getresponse()
+            except (httplib.BadStatusLine, socket.error), e:
+                self.close()
+                stale = isinstance(e, httplib.BadStatusLine) or e.errno in (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+                if attempt or not reused or not stale:
+                    raise
+                log.debug("connection to %s was closed, reconnecting" % self.host)
+
+    def post(self, path, body, content_type):
+        """ POST body to path and return the response body """
+        headers = { 'Content-Type' : content_type }
+        if self.use_gzip:
+            headers['Accept-Encoding'] = 'gzip'
+            if len(body) > self.gzip_threshold:
+                compressed = StringIO()
+                gzip_file = gzip.GzipFile(fileobj=compressed, mode='wb', compresslevel=1)
+                gzip_file.write(body)
+                gzip_file.close()
+                body = compressed.getvalue()
+                headers['Content-Encoding'] = 'gzip'
+
+        self.bytes_sent += len(body)
+        response = self._send(path, body, headers)
+        data = response.read()
+        self.bytes_received += len(data)
+        if response.will_close:
+            self.close()
+        if response.status != 200:
+            raise xmlrpclib.ProtocolError(self.host + path, response.status, response.reason, response.msg)
+        if response.getheader('content-encoding', '') == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        return data
+
+
+class XmlRpcTransport(xmlrpclib.Transport):
+    """ xmlrpclib transport that sends every request over one Connection """
+
+    def __init__(self, connection):
+        xmlrpclib.Transport.__init__(self)
+        self.connection = connection
+
+    def request(self, host, handler, request_body, verbose=0):
+        parser, unmarshaller = self.getparser()
+        parser.feed(self.connection.post(handler, request_body, 'text/xml'))
+        parser.close()
+        return unmarshaller.close()
+
+    def close(self):
+        self.connection.close()
+
+
+class JsonRpcProxy:
+    """ a stand-in for xmlrpclib.ServerProxy that talks to xapi's JSON-RPC
+        endpoint.  JSON is much cheaper than XML-RPC to parse for the big
+        get_all_records responses """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.request_id = 0
+
+    def _request(self, method, params):
+        self.request_id += 1
+        body = json.dumps({ 'jsonrpc' : '2.0', 'method' : method, 'params' : params, 'id' : self.request_id })
+        response = json.loads(self.connection.post('/jsonrpc', body, 'application/json'))
+        if response.get('error'):
+            error = response['error']
+            return { 'Status' : 'Failure', 'ErrorDescription' : [error.get('message', str(error.get('code')))] + list(error.get('data') or []) }
+        return { 'Status' : 'Success', 'Value' : response.get('result') }
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return xmlrpclib._Method(self._request, name)
+
+
+def xenapi_proxy(url, protocol='xmlrpc', use_gzip=False, recorder=None):
+    """ a XenAPI proxy for url using protocol, which is one of protocols.
+        every call through it is recorded by recorder (an instrument.Recorder), if given """
+    connection = Connection(url, use_gzip)
+    if protocol == 'jsonrpc':
+        proxy = JsonRpcProxy(connection)
+    elif protocol == 'xmlrpc':
+        proxy = xmlrpclib.ServerProxy(url, transport=XmlRpcTransport(connection))
+    else:
+        raise ValueError("unknown XenAPI protocol '%s', expected one of %s" % (protocol, ', '.join(protocols)))
+    if recorder:
+        return recorder.wrap(proxy, 'xenapi', connection)
+    return proxy